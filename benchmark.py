@@ -0,0 +1,339 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# BENCHMARK -- time every stage of plot_covid on synthetic data
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+Reproducible timings of the stages of plot_covid, run on synthetic files
+shaped like the NYT and Johns Hopkins files, so no network is involved and
+every run sees the same data:
+
+    startup     import plot_covid in a new interpreter, what every run pays first
+    fetch       copy the three files into an empty cache
+    parse       split the NYT file by state and compile the Johns Hopkins snapshot
+    index       build the LocationIndex
+    resolve     resolve the location names
+    series      get_data for every location
+    rolling     rolling_mean of cases and deaths
+    rt          R(t) of all locations at once
+    lethality   fatality rate and lag of all locations at once
+    fit-cases   the curve_fit of the cases model
+    fit-deaths  the curve_fit of the deaths model
+    fit-cached  the cases model again, from the fit_cache
+    predict     predict of both models, for all locations and ForecastHorizons at once
+    render      plot_data into memory, headless, for at most <render> locations
+
+for 1, 50 and all locations, and for several lengths of the history. Every
+stage is timed <repeat> times and the fastest time counts. The results are
+written as JSON, two of those files can be compared.
+
+    python benchmark.py [days 100,200,400] [locations 1,50,all] [repeat 3] [render 10] [output benchmark.json]
+    python benchmark.py compare old.json new.json
+"""
+
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+import subprocess
+
+import numpy as np
+
+from datetime import date, timedelta
+
+from iso3166 import countries as Countries
+from us_states import us_states
+
+import data_cache
+import fit_cache
+import modeling
+import plot_covid as pc
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONSTANTS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+DAYS = 'days'
+LOCATIONS = 'locations'
+REPEAT = 'repeat'
+RENDER = 'render'
+OUTPUT = 'output'
+STAGE = 'stage'
+SECONDS = 'seconds'
+COUNT = 'count'
+RESULTS = 'results'
+ABOUT = 'about'
+
+NYTStart = date(2020, 1, 21)
+JHUStart = date(2020, 1, 22)
+Provinces = {'Canada': ['Alberta', 'British Columbia', 'Manitoba', 'Ontario', 'Quebec'],
+             'Australia': ['New South Wales', 'Queensland', 'Victoria'],
+             'China': ['Beijing', 'Hubei', 'Shanghai'],
+            }
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# FIXTURES -- synthetic data files
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def synthetic_cumulative(random, days, top):
+    """
+    Cumulative numbers from a covid_curve wave with noise, never decreasing.
+    """
+    offset = random.uniform(-0.7, -0.2) * days
+    daily = pc.covid_curve(pc.relative_days(days), offset, top, random.uniform(4, 12), random.uniform(15, 40))
+    return np.cumsum(random.poisson(np.maximum(daily, 0)))
+
+
+def jhu_date(day):
+    return str(day.month) + '/' + str(day.day) + '/' + day.strftime('%y')
+
+
+def make_fixtures(directory, days, seed=2020):
+    """
+    Write us-states.csv and the two Johns Hopkins files for days days into
+    directory. Every state starts on a different day; every ISO 3166 country
+    gets a row, spelled like in the Johns Hopkins file, and a few countries
+    only have rows for their provinces. Returns all location names, sorted.
+    """
+    random = np.random.RandomState(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    states = sorted(us_states)
+    series = {state: (synthetic_cumulative(random, days, random.uniform(500, 10000)),
+                      synthetic_cumulative(random, days, random.uniform(10, 300))) for state in states}
+    first = {state: random.randint(0, days // 5) for state in states}
+    with open(os.path.join(directory, pc.StateFile), 'w') as f:
+        f.write('date,state,fips,cases,deaths\n')
+        for day in range(days):
+            today = (NYTStart + timedelta(day)).isoformat()
+            for number, state in enumerate(states, 1):
+                if day >= first[state]:
+                    cases, deaths = series[state]
+                    f.write('%s,%s,%02d,%d,%d\n' % (today, state, number, cases[day], deaths[day]))
+
+    rows = []
+    for country in Countries:
+        name = pc.CountryExceptions.get(country.name, country.name)
+        for province in Provinces.get(name, ['']):
+            rows.append((province, name))
+    header = 'Province/State,Country/Region,Lat,Long,' + ','.join(jhu_date(JHUStart + timedelta(day)) for day in range(days)) + '\n'
+    values = [(synthetic_cumulative(random, days, random.uniform(500, 50000)), synthetic_cumulative(random, days, random.uniform(10, 1000))) for row in rows]
+    for name, which in [(pc.ConfirmedFile, 0), (pc.DeathsFile, 1)]:
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(header)
+            for (province, country), numbers in zip(rows, values):
+                country = '"' + country + '"' if ',' in country else country
+                province = '"' + province + '"' if ',' in province else province
+                f.write(province + ',' + country + ',0.0,0.0,' + ','.join(str(value) for value in numbers[which]) + '\n')
+
+    return sorted(set(states + [country for province, country in rows]))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# STAGES
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def measure(run, setup=None, repeat=3):
+    """
+    Fastest wall time of run(state) over repeat runs, with state = setup().
+    """
+    best = None
+    for attempt in range(repeat):
+        state = None if setup is None else setup()
+        start = time.perf_counter()
+        run(state)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def import_plot_covid():
+    subprocess.run([sys.executable, '-c', 'import plot_covid'], cwd=os.path.dirname(os.path.abspath(pc.__file__)), check=True)
+
+
+def fresh_cache():
+    shutil.rmtree(data_cache.CacheDirectory, ignore_errors=True)
+    os.makedirs(data_cache.CacheDirectory)
+
+
+def fetch_all():
+    data_cache.fetch_many([pc.StateDataLocation + pc.StateFile, pc.GlobalDataLocation + pc.ConfirmedFile, pc.GlobalDataLocation + pc.DeathsFile])
+
+
+def remove_stores():
+    """
+    Everything parsed from the data files, not the files themselves.
+    """
+    for name in os.listdir(data_cache.CacheDirectory):
+        path = os.path.join(data_cache.CacheDirectory, name)
+        if name.startswith('states-') or name.startswith('snapshot-'):
+            shutil.rmtree(path)
+        elif name == pc.IndexFile:
+            os.remove(path)
+
+
+def loaded_dataset():
+    pc.Data = None
+    dataset = pc.load_dataset()
+    dataset.load_states()
+    dataset.load_global()
+    return dataset
+
+
+def benchmark(days, scales, repeat=3, render=10):
+    """
+    Results for one history length: a list of {days, locations, stage, seconds, count}.
+    """
+    fixtures = tempfile.mkdtemp(prefix='covid-benchmark-')
+    names = make_fixtures(os.path.join(fixtures, 'data'), days)
+    pc.StateDataLocation = pc.GlobalDataLocation = 'file://' + os.path.join(fixtures, 'data') + '/'
+    data_cache.CacheDirectory = os.path.join(fixtures, 'cache')
+    results = []
+
+    def record(locations, stage, seconds, count):
+        results.append({DAYS: days, LOCATIONS: locations, STAGE: stage, SECONDS: seconds, COUNT: count})
+        print('{0:>6} {1:>9} {2:<11} {3:>10.4f} s'.format(days, locations, stage, seconds))
+
+    try:
+        # the whole files, the same for any number of locations
+
+        record(len(names), 'startup', measure(lambda state: import_plot_covid(), None, repeat), 1)
+        record(len(names), 'fetch', measure(lambda state: fetch_all(), fresh_cache, repeat), 3)
+        record(len(names), 'parse', measure(lambda state: loaded_dataset(), remove_stores, repeat), 3)
+        record(len(names), 'index', measure(lambda dataset: dataset.location_index(), lambda: (remove_stores(), loaded_dataset())[1], repeat), len(names))
+
+        for scale in scales:
+            locations = names if scale == 'all' else names[:int(scale)]
+            count = len(locations)
+            dataset = loaded_dataset()
+            index = dataset.location_index()
+
+            def series(state):
+                data = []
+                for name in locations:
+                    series = pc.get_data({pc.LOCATION: name, pc.STARTDATE: NYTStart.isoformat(), pc.VERBOSE: False})
+                    if series is not None:
+                        data.append(series)
+                return data
+
+            def reset():
+                dataset.global_cache = {}
+                dataset.region_cache = {}
+
+            record(count, 'resolve', measure(lambda state: [index.resolve(pc.normalize_location(name)) for name in locations], None, repeat), count)
+            record(count, 'series', measure(series, reset, repeat), count)
+            data = series(None)
+
+            record(count, 'rolling', measure(lambda state: [(pc.rolling_mean(item.cases, 7), pc.rolling_mean(item.deaths, 7)) for item in data], None, repeat), count)
+
+            import scipy.optimize, matplotlib.figure   # imported on first use, keep that out of the timings
+
+            record(count, 'rt', measure(lambda state: modeling.reproduction_number(pc.stack_series([item.cases for item in data])), None, repeat), count)
+            record(count, 'lethality', measure(lambda state: modeling.lethality(pc.stack_series([item.cases for item in data]), pc.stack_series([item.deaths for item in data])), None, repeat), count)
+
+            fits = {}
+            for which, stage, guess in [(0, 'fit-cases', -70), (1, 'fit-deaths', -60), (0, 'fit-cached', -70)]:
+                def fit(state):
+                    for number, item in enumerate(data):
+                        values = item.deaths if which else item.cases
+                        fits[(number, which)] = pc.fit_curve(item.xvalues, values, (guess, 2 * np.max(pc.rolling_mean(values, 7)), 5, 50))
+                fit_cache.trim(0)
+                if stage == 'fit-cached':
+                    fit(None)
+                record(count, stage, measure(fit, None, 1 if stage != 'fit-cached' else repeat), count)
+
+            def predict(state):
+                past = [len(item) for item in data]
+                for which in [0, 1]:
+                    pc.predict(pc.model_array([fits[(number, which)] for number in range(len(data))]), past, pc.ForecastHorizons)
+            record(count, 'predict', measure(predict, None, repeat), count)
+
+            shown = data[:render]
+            def draw(state):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for number, series in enumerate(shown):
+                        popt = [None if fits[(number, which)] is None else np.array(fits[(number, which)]) for which in [0, 1]]
+                        pc.plot_data(series, {pc.XKCD: False}, popt, output=io.BytesIO())
+            record(count, 'render', measure(draw, None, 1), len(shown))
+    finally:
+        shutil.rmtree(fixtures, ignore_errors=True)
+
+    return results
+
+
+def about():
+    """
+    What the results were measured on.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# COMPARE
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def compare(old_path, new_path, tolerance=1.1):
+    """
+    Print the old and new time of every stage, marking the ones that got
+    slower by more than tolerance.
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_times = {(item[DAYS], item[LOCATIONS], item[STAGE]): item[SECONDS] for item in old[RESULTS]}
+
+    print(old[ABOUT].get('commit'), '->', new[ABOUT].get('commit'))
+    print('{0:>6} {1:>9} {2:<11} {3:>10} {4:>10} {5:>7}'.format('Days', 'Locations', 'Stage', 'Old', 'New', 'Ratio'))
+    for item in new[RESULTS]:
+        key = (item[DAYS], item[LOCATIONS], item[STAGE])
+        if key in old_times and old_times[key] > 0:
+            ratio = item[SECONDS] / old_times[key]
+            print('{0:>6} {1:>9} {2:<11} {3:>10.4f} {4:>10.4f} {5:>7.2f}{6}'.format(*key, old_times[key], item[SECONDS], ratio, ' slower' if ratio > tolerance else ''))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# MAIN
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+if __name__ == "__main__":
+
+    argv = sys.argv[1:]
+
+    if 'compare' in argv[:-2]:
+        num = argv.index('compare')
+        compare(argv[num + 1], argv[num + 2])
+        exit()
+
+    settings = {DAYS: '100,200,400', LOCATIONS: '1,50,all', REPEAT: '3', RENDER: '10', OUTPUT: 'benchmark.json'}
+    for item in settings:
+        if item in argv[:-1]:
+            settings[item] = argv[argv.index(item) + 1]
+
+    cache_directory = data_cache.CacheDirectory
+    results = []
+    for days in [int(item) for item in settings[DAYS].split(',')]:
+        results += benchmark(days, settings[LOCATIONS].split(','), int(settings[REPEAT]), int(settings[RENDER]))
+    data_cache.CacheDirectory = cache_directory
+
+    with open(settings[OUTPUT], 'w') as f:
+        json.dump({ABOUT: about(), RESULTS: results}, f, indent=1)
+    print("Results written to", settings[OUTPUT])
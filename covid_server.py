@@ -0,0 +1,349 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# COVID SERVER -- answer location queries over HTTP
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+A long-running web service for the covid dashboard. The data files are parsed
+once and the fitted models are kept in memory, so a query only computes what
+it has not computed before. All endpoints take ?location=...&start=yyyy-mm-dd
+
+    /series               daily cases and deaths as JSON
+    /model                the numbers covid_predict prints, as JSON, also
+                          takes &horizons=7,30,... for more days ahead
+    /plot.png /plot.svg   the plot, also takes &xkcd=1 and &ylimit=...
+
+Responses are kept in an LRU cache keyed on (query, data version) and carry an
+ETag, a client that sends If-None-Match gets a 304 without any work at all.
+Concurrent requests for the same response, or the same fit, wait for the one
+that is being made instead of making it again.
+Models are fitted and plots are rendered by a pool of worker processes, so
+concurrent requests do not wait for each other on scipy or matplotlib.
+The data files are revalidated every data_cache.CacheTTL seconds.
+
+Run with:  python covid_server.py [host localhost] [port 8050] [workers N]
+"""
+
+
+import io
+import sys
+import json
+import time
+import hashlib
+import threading
+import contextlib
+import urllib.parse
+
+import numpy as np
+
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import data_cache
+import plot_covid as pc
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONSTANTS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+HOST = 'host'
+PORT = 'port'
+START = 'start'
+ERROR = 'error'
+HORIZONS = 'horizons'
+
+SERIES = 'series'
+MODEL = 'model'
+PLOT_PNG = 'plot.png'
+PLOT_SVG = 'plot.svg'
+
+ContentTypes = { SERIES: 'application/json',
+                 MODEL: 'application/json',
+                 PLOT_PNG: 'image/png',
+                 PLOT_SVG: 'image/svg+xml',
+               }
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SETTINGS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+DefaultLocation = 'Massachusetts'
+DefaultStart = '2020-03-15'
+ResponseCacheSize = 256   # responses kept in memory
+FitCacheSize = 1024       # fitted series kept in memory
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SERVICE -- the state shared by all request threads
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class Service():
+    """
+    The dataset, the fitted models and the cached responses.
+    The Dataset is not thread-safe, every use of it holds the lock,
+    fitting and rendering happen in the pool without it.
+    """
+
+    def __init__(self, workers=None):
+        self.lock = threading.Lock()
+        self.pool = ProcessPoolExecutor(workers)
+        self.responses = OrderedDict()   # (endpoint, location, start, options, data version) -> (status, body)
+        self.fits = OrderedDict()        # series fingerprint -> (cases_popt, deaths_popt)
+        self.pending = {}                # response key or series fingerprint -> Future, while being made
+        self.checked = 0                 # when the data files were revalidated
+        self.version = None
+
+    def data_version(self):
+        """
+        Changes with any of the data files, which are revalidated every
+        data_cache.CacheTTL seconds. Only new data is parsed then.
+        """
+        with self.lock:
+            if time.time() - self.checked > data_cache.CacheTTL:
+                dataset = pc.load_dataset(refresh=self.checked > 0)
+                if self.checked == 0:
+                    dataset.prefetch()
+                dataset.load_states()
+                dataset.load_global()
+                urls = [pc.StateDataLocation + pc.StateFile, pc.GlobalDataLocation + pc.ConfirmedFile, pc.GlobalDataLocation + pc.DeathsFile]
+                self.version = hashlib.sha1(' '.join(str(data_cache.version(url)) for url in urls).encode()).hexdigest()[:16]
+                self.checked = time.time()
+            return self.version
+
+    def claim(self, key):
+        """
+        Called with the lock held: (Future, True) when this thread is to make
+        what key stands for, or the Future of the thread making it and False.
+        """
+        if key in self.pending:
+            return self.pending[key], False
+        self.pending[key] = Future()
+        return self.pending[key], True
+
+    def settle(self, key, future, make):
+        """
+        Make what this thread claimed key for, hand it to the threads waiting
+        on future, also when make() fails.
+        """
+        try:
+            result = make()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    def cached(self, key, make):
+        """
+        The response for key, made by make() only the first time.
+        """
+        with self.lock:
+            if key in self.responses:
+                self.responses.move_to_end(key)
+                return self.responses[key]
+            future, owner = self.claim(key)
+        if not owner:
+            return future.result()
+
+        def make_and_remember():
+            response = make()
+            with self.lock:
+                remember(self.responses, key, response, ResponseCacheSize)
+            return response
+        return self.settle(key, future, make_and_remember)
+
+    def series(self, location, start):
+        """
+        get_data for location: a pc.Series, or None.
+        """
+        with self.lock:
+            return pc.get_data({pc.LOCATION: location, pc.STARTDATE: start, pc.VERBOSE: False})
+
+    def model_fits(self, series):
+        """
+        The fits of the series, from memory, from the fit_cache, or fitted in the pool.
+        """
+        fingerprint = pc.series_fingerprint(series.cases, series.deaths)
+        with self.lock:
+            fits = self.fits.get(fingerprint) or pc.cached_fits(series.cases, series.deaths, series.xvalues)
+            if fits is None:
+                future, owner = self.claim(fingerprint)
+        if fits is None and not owner:
+            fits = future.result()
+        elif fits is None:
+
+            def fit():
+                fits = self.pool.submit(pc.fit_models, series.cases, series.deaths, series.xvalues).result()
+                with self.lock:
+                    pc.remember_fits(series.location, series.lastday, fits)
+                    remember(self.fits, fingerprint, fits, FitCacheSize)
+                return fits
+            fits = self.settle(fingerprint, future, fit)
+        with self.lock:
+            remember(self.fits, fingerprint, fits, FitCacheSize)
+        return fits
+
+
+def remember(cache, key, value, size):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# RESPONSES -- (status, body) for each endpoint
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def make_response(service, endpoint, location, start, query):
+    try:
+        valid = not np.isnat(np.datetime64(start))
+    except ValueError:
+        valid = False
+    if not valid:
+        return 400, json_body({ERROR: 'Start is a date, yyyy-mm-dd: ' + start})
+
+    series = service.series(location, start)
+    if series is None:
+        return 404, json_body({ERROR: 'Unknown location, or no data for it: ' + location})
+
+    if endpoint == SERIES:
+        return 200, json_body({pc.LOCATION: series.location,
+                               pc.LASTDAY: series.lastday,
+                               pc.DATE: [str(date) for date in series.dates[series.start:]],
+                               pc.CASES: series.cases.tolist(),
+                               pc.DEATHS: series.deaths.tolist(),
+                               pc.TOTALCASES: int(series.total_cases),
+                               pc.TOTALDEATHS: int(series.total_deaths),
+                              })
+
+    fits = service.model_fits(series)
+
+    if endpoint == MODEL:
+        result = {pc.LOCATION: series.location, pc.LASTDAY: series.lastday}
+        horizons = [days.strip() for days in query.get(HORIZONS, '').split(',') if days.strip()]
+        if not all(days.isdigit() for days in horizons):
+            return 400, json_body({ERROR: 'Horizons are numbers of days: ' + query[HORIZONS]})
+        horizons = [int(days) for days in horizons]
+        prediction = pc.predict(pc.model_array(fits), len(series), [180] + horizons)
+        for number, (name, popt) in enumerate(zip([pc.CASES, pc.DEATHS], fits)):
+            if popt is None:
+                result[name] = None
+                continue
+            result[name] = {pc.PEAK: int(prediction[pc.PEAK][number]), pc.SOFAR: float(prediction[pc.SOFAR][number]),
+                            pc.COMING: float(prediction[pc.COMING][number, 0]), pc.TOTAL: float(prediction[pc.TOTAL][number, 0])}
+            if horizons:
+                result[name][HORIZONS] = {str(days): {pc.COMING: float(coming), pc.TOTAL: float(total)}
+                                          for days, coming, total in zip(horizons, prediction[pc.COMING][number, 1:], prediction[pc.TOTAL][number, 1:])}
+        lethality = pc.modeling.lethality(series.cases, series.deaths)
+        if not np.isnan(lethality[pc.modeling.FATALITY]):
+            result['fatality-rate'] = float(100 * lethality[pc.modeling.FATALITY])
+            result['fatality-rate-interval'] = [float(100 * lethality[pc.modeling.FATALITY_LOW]), float(100 * lethality[pc.modeling.FATALITY_HIGH])]
+            result['lag'] = float(lethality[pc.modeling.LAG])
+            result['lag-interval'] = [float(lethality[pc.modeling.LAG_LOW]), float(lethality[pc.modeling.LAG_HIGH])]
+        return 200, json_body(result)
+
+    parameters = {pc.XKCD: query.get(pc.XKCD, '') not in ['', '0', 'false'],
+                  pc.SVG: endpoint == PLOT_SVG}
+    if query.get('ylimit'):
+        parameters[pc.YLIMIT] = query['ylimit']
+    return 200, service.pool.submit(render, series, parameters, fits).result()
+
+
+def render(series, parameters, fits):
+    """
+    The plot as PNG or SVG bytes, runs in a worker process.
+    """
+    output = io.BytesIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        pc.plot_data(series, parameters, fits, output=output)
+    return output.getvalue()
+
+
+def json_body(value):
+    return json.dumps(value).encode()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# HTTP
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        endpoint = url.path.strip('/')
+        if endpoint not in ContentTypes:
+            self.send(404, ContentTypes[SERIES], json_body({ERROR: 'Endpoints are: ' + ', '.join('/' + item for item in ContentTypes)}))
+            return
+
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        location = query.get(pc.LOCATION, DefaultLocation)
+        start = query.get(START, DefaultStart)
+        options = (query.get(pc.XKCD), query.get('ylimit')) if endpoint in [PLOT_PNG, PLOT_SVG] else (query.get(HORIZONS),) if endpoint == MODEL else ()
+
+        service = self.server.service
+        key = (endpoint, location, start, options, service.data_version())
+        etag = '"' + hashlib.sha1(repr(key).encode()).hexdigest()[:20] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send(304, None, b'', etag)
+            return
+
+        try:
+            status, body = service.cached(key, lambda: make_response(service, endpoint, location, start, query))
+        except Exception as error:   # keep serving, but do not cache the failure
+            self.send(500, ContentTypes[SERIES], json_body({ERROR: str(error)}))
+            return
+        self.send(status, ContentTypes[endpoint] if status == 200 else ContentTypes[SERIES], body, etag)
+
+    def send(self, status, content_type, body, etag=None):
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host='localhost', port=8050, workers=None):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.service = Service(workers)
+    print("Serving covid data on http://" + host + ":" + str(port) + "/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.service.pool.shutdown()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# MAIN
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+if __name__ == "__main__":
+
+    argv = sys.argv[1:]
+    settings = {HOST: 'localhost', PORT: 8050, pc.WORKERS: None}
+    for item in settings:
+        if item in argv[:-1]:
+            value = argv[argv.index(item) + 1]
+            settings[item] = value if item == HOST else int(value)
+
+    serve(settings[HOST], settings[PORT], settings[pc.WORKERS])
@@ -0,0 +1,436 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DATA CACHE -- keep a local copy of the downloaded data files
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+Local on-disk cache for the NYT and Johns Hopkins data files.
+
+The raw bytes of every download are stored together with the ETag and
+Last-Modified headers of the response.  Within CacheTTL seconds a cached file
+is used without touching the network at all; after that it is revalidated with
+a conditional GET and only downloaded again when the server has a new version.
+
+Files that only ever grow at the end, like the NYT us-states.csv, can be
+fetched with append: then only the bytes after the cached copy are requested.
+Changes to older rows cannot be seen that way, so these files are still
+downloaded completely when the last complete download is older than FullDays.
+
+HTTP requests go over kept-alive connections, one pool per host, and failed
+requests and server errors are tried again Retries times. fetch_many fetches
+several files at the same time, so a run waits for the slowest file instead of
+for all files one after the other.
+"""
+
+
+import os
+import json
+import shutil
+import time
+import hashlib
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONSTANTS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+URL = 'url'
+ETAG = 'etag'
+LAST_MODIFIED = 'last-modified'
+CHECKED = 'checked'
+DOWNLOADED = 'downloaded'
+DIGEST = 'digest'
+SIZE = 'size'
+
+REQUESTS = 'requests'
+DOWNLOADS = 'downloads'
+APPENDS = 'appends'
+BYTES = 'bytes'
+NOT_MODIFIED = 'not-modified'
+HITS = 'hits'
+SECONDS = 'seconds'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SETTINGS -- can be changed through the environment
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+CacheDirectory = os.environ.get('COVID_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'covid-plotting'))
+CacheTTL = float(os.environ.get('COVID_CACHE_TTL', 3600))   # seconds before a cached file is revalidated
+Timeout = 60   # seconds
+Retries = 2        # more attempts after a network error or a server error
+RetryDelay = 0.5   # seconds before the first retry, doubled for every next one
+BlockSize = 1 << 16
+Overlap = 4096   # bytes at the end of a cached copy that are requested again, to check that it still fits
+FullDays = float(os.environ.get('COVID_CACHE_FULL_DAYS', 7))   # days between complete downloads of appended files
+
+# what happened during this run, mostly to check that a warm run stays off the network
+
+Statistics = {REQUESTS: 0, DOWNLOADS: 0, APPENDS: 0, BYTES: 0, NOT_MODIFIED: 0, HITS: 0, SECONDS: 0.0}
+StatisticsLock = threading.Lock()
+
+
+def count(key, amount=1):
+    with StatisticsLock:
+        Statistics[key] += amount
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CACHE
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def cache_path(url, directory=None):
+    """
+    Local file name for url: short hash of the url, so equal file names from
+    different places do not collide, followed by the original file name.
+    """
+    directory = directory or CacheDirectory
+    name = url.rstrip('/').split('/')[-1] or 'index'
+    return os.path.join(directory, hashlib.sha1(url.encode()).hexdigest()[:10] + '-' + name)
+
+
+def read_metadata(url, directory=None):
+    """
+    Headers and bookkeeping stored next to the cached file, {} if not cached.
+    """
+    path = cache_path(url, directory)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_metadata(url, metadata, directory=None):
+    path = cache_path(url, directory) + '.json'
+    with open(path + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def version(url, directory=None):
+    """
+    Digest of the cached copy of url, changes whenever the content changes.
+    """
+    return read_metadata(url, directory).get(DIGEST)
+
+
+def file_digest(path, size=None):
+    """
+    Digest of the file, or of its first size bytes.
+    """
+    digest = hashlib.sha1()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(BlockSize, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def fetch(url, ttl=None, directory=None, append=False):
+    """
+    Return the name of a local file with the content of url.
+    A cached copy younger than ttl seconds is used as is, an older one is
+    revalidated with a conditional GET. If the network is not available
+    an existing cached copy is used anyway.
+    With append, only the bytes after the end of the cached copy are fetched.
+    """
+    directory = directory or CacheDirectory
+    ttl = CacheTTL if ttl is None else ttl
+    path = cache_path(url, directory)
+    metadata = read_metadata(url, directory)
+
+    if is_fresh(metadata, ttl):
+        count(HITS)
+        return path
+
+    start = time.perf_counter()
+    try:
+        return revalidate(url, metadata, directory, append)
+    finally:
+        count(SECONDS, time.perf_counter() - start)
+
+
+def is_fresh(metadata, ttl):
+    return bool(metadata) and time.time() - metadata.get(CHECKED, 0) < ttl
+
+
+def fetch_many(urls, ttl=None, directory=None, append=()):
+    """
+    fetch for several urls at the same time, returns their local file names
+    in the same order. The urls in append are fetched with append.
+    When a fetch fails, the others still finish before the error is raised.
+    """
+    directory = directory or CacheDirectory
+    ttl = CacheTTL if ttl is None else ttl
+    stale = [url for url in urls if not is_fresh(read_metadata(url, directory), ttl)]
+    if len(stale) <= 1:
+        return [fetch(url, ttl, directory, url in append) for url in urls]
+
+    import asyncio
+
+    async def fetch_all():
+        return await asyncio.gather(*[asyncio.to_thread(fetch, url, ttl, directory, url in append) for url in urls], return_exceptions=True)
+
+    paths = asyncio.run(fetch_all())
+    for path in paths:
+        if isinstance(path, BaseException):
+            raise path
+    return paths
+
+
+def revalidate(url, metadata, directory, append=False):
+    """
+    The network part of fetch.
+    """
+    path = cache_path(url, directory)
+    os.makedirs(directory, exist_ok=True)
+    if append and metadata.get(SIZE) and time.time() - metadata.get(DOWNLOADED, 0) < FullDays * 86400:
+        if fetch_appended(url, metadata, directory):
+            return path
+
+    headers = {}
+    if metadata.get(ETAG):
+        headers['If-None-Match'] = metadata[ETAG]
+    if metadata.get(LAST_MODIFIED):
+        headers['If-Modified-Since'] = metadata[LAST_MODIFIED]
+
+    count(REQUESTS)
+    try:
+        response = open_url(url, headers)
+    except urllib.error.HTTPError as error:
+        if error.code == 304 and metadata:
+            count(NOT_MODIFIED)
+            metadata[CHECKED] = time.time()
+            write_metadata(url, metadata, directory)
+            return path
+        if metadata:
+            print("Could not refresh", url, "(" + str(error) + "), using cached copy.")
+            return path
+        raise
+    except (urllib.error.URLError, OSError) as error:
+        if metadata:
+            print("Could not refresh", url, "(" + str(error) + "), using cached copy.")
+            return path
+        raise
+
+    with response:
+        save_response(url, response, directory)
+    return path
+
+
+def save_response(url, response, directory):
+    """
+    Write the body of response to the cache, with its metadata.
+    """
+    path = cache_path(url, directory)
+    digest = hashlib.sha1()
+    size = 0
+    with open(path + '.tmp', 'wb') as f:
+        while True:
+            block = response.read(BlockSize)
+            if not block:
+                break
+            f.write(block)
+            digest.update(block)
+            size += len(block)
+    os.replace(path + '.tmp', path)
+
+    count(DOWNLOADS)
+    count(BYTES, size)
+    write_metadata(url, {URL: url,
+                         ETAG: response.headers.get('ETag'),
+                         LAST_MODIFIED: response.headers.get('Last-Modified'),
+                         CHECKED: time.time(),
+                         DOWNLOADED: time.time(),
+                         DIGEST: digest.hexdigest(),
+                         SIZE: size,
+                        }, directory)
+
+
+def fetch_appended(url, metadata, directory):
+    """
+    Revalidate the cached copy of a file that only grows at the end: request
+    everything from Overlap bytes before the end of the copy, check that these
+    bytes and the total size agree with the copy, and append the rest.
+    Returns False when that does not work out, then the whole file is fetched.
+    """
+    path = cache_path(url, directory)
+    size = metadata[SIZE]
+    start = max(0, size - Overlap)
+
+    headers = {'Range': 'bytes=' + str(start) + '-'}
+    if metadata.get(ETAG):
+        headers['If-None-Match'] = metadata[ETAG]
+
+    count(REQUESTS)
+    try:
+        response = open_url(url, headers)
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            count(NOT_MODIFIED)
+            metadata[CHECKED] = time.time()
+            write_metadata(url, metadata, directory)
+            return True
+        return False   # e.g. 416, the file got smaller
+    except (urllib.error.URLError, OSError) as error:
+        print("Could not refresh", url, "(" + str(error) + "), using cached copy.")
+        return True
+
+    with response:
+        if response.status != 206:   # no ranges here, this is the whole file
+            save_response(url, response, directory)
+            return True
+        body = response.read()
+        total = response.headers.get('Content-Range', '').split('/')[-1]
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    count(BYTES, len(body))
+    with open(path, 'rb') as f:
+        f.seek(start)
+        overlap = f.read()
+    if body[:len(overlap)] != overlap or total != str(start + len(body)):
+        return False
+
+    shutil.copyfile(path, path + '.tmp')
+    with open(path + '.tmp', 'ab') as f:
+        f.write(body[len(overlap):])
+    os.replace(path + '.tmp', path)
+
+    count(APPENDS)
+    metadata.update({ETAG: etag, LAST_MODIFIED: last_modified, CHECKED: time.time(),
+                     DIGEST: file_digest(path), SIZE: start + len(body)})
+    write_metadata(url, metadata, directory)
+    return True
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONNECTIONS -- kept-alive HTTP connections, with retries
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+Pool = {}   # (scheme, host) -> idle connections
+PoolLock = threading.Lock()
+Redirects = 5
+
+
+def open_url(url, headers=None, redirects=Redirects):
+    """
+    GET url, like urllib.request.urlopen: returns the response, raises
+    urllib.error.HTTPError for 304 and error statuses, and URLError when the
+    server cannot be reached. Http and https use a connection from the Pool,
+    that goes back to it when the response was read completely.
+    Network errors and server errors are tried again after RetryDelay seconds.
+    Other schemes, and urls that go through a proxy (HTTP_PROXY, HTTPS_PROXY
+    and NO_PROXY), are left to urlopen.
+    """
+    headers = headers or {}
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ['http', 'https'] or is_proxied(parts):
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=Timeout)
+    host = (parts.scheme, parts.netloc)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+    attempt = 0
+    while True:
+        connection, reused = pooled_connection(host)
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as error:
+            connection.close()
+            if reused:   # kept alive too long, the server closed it
+                continue
+            if attempt == Retries:
+                raise urllib.error.URLError(error)
+        else:
+            if 300 <= response.status < 400 and response.status != 304 and redirects > 0:
+                response.read()
+                release(host, connection, response)
+                return open_url(urllib.parse.urljoin(url, response.headers.get('Location', '')), headers, redirects - 1)
+            if response.status < 500 or attempt == Retries:
+                break
+            response.read()   # a server error, try again
+            release(host, connection, response)
+        time.sleep(RetryDelay * 2 ** attempt)
+        attempt += 1
+
+    if response.status >= 300:
+        response.read()
+        release(host, connection, response)
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+    return PooledResponse(host, connection, response)
+
+
+def is_proxied(parts):
+    """
+    Whether urllib would send the request of the split url to a proxy.
+    """
+    return parts.scheme in urllib.request.getproxies() and not urllib.request.proxy_bypass(parts.hostname or '')
+
+
+def pooled_connection(host):
+    """
+    (connection, True) for an idle connection to host, (new connection, False) if there is none.
+    """
+    with PoolLock:
+        if Pool.get(host):
+            return Pool[host].pop(), True
+    scheme, netloc = host
+    connection = http.client.HTTPSConnection(netloc, timeout=Timeout) if scheme == 'https' else http.client.HTTPConnection(netloc, timeout=Timeout)
+    return connection, False
+
+
+def release(host, connection, response):
+    """
+    Back to the pool when the whole response was read, otherwise closed.
+    """
+    if response.isclosed() and not response.will_close:
+        with PoolLock:
+            Pool.setdefault(host, []).append(connection)
+    else:
+        connection.close()
+
+
+class PooledResponse():
+    """
+    A response on a pooled connection, used like the response of urlopen.
+    """
+
+    def __init__(self, host, connection, response):
+        self.host = host
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, size=-1):
+        return self.response.read(size if size >= 0 else None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        release(self.host, self.connection, self.response)
+
+
+def clear(directory=None):
+    """
+    Remove all cached files.
+    """
+    directory = directory or CacheDirectory
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
@@ -0,0 +1,363 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DATA STORE -- binary snapshots of the Johns Hopkins and NYT time series
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+The Johns Hopkins files have one column per date and grow every day, so
+parsing them gets slower over time. They are compiled once into a snapshot
+directory with
+
+    cases.npy, deaths.npy   locations x days matrices, int32 unless int64 is needed
+    dates.npy               the date of every column, datetime64[D]
+    keys.json               Province/State and Country/Region of every row, the version,
+                            and digests of the text of both files up to the last column
+
+The matrices are memory-mapped when loaded, so looking up a location only
+reads its own rows, no matter how long the history is. For a new version of
+the files only the new date columns are converted and appended, as long as
+the digests show that nothing before them changed.
+
+The NYT us-states.csv is kept split by state in the same way. It grows by
+rows at the end, so a new version is only parsed from where the last one ended,
+in chunks of ChunkSize bytes, however long the file has become.
+
+Run this file to compile the snapshots ahead of time.
+"""
+
+
+import os
+import csv
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from array import array
+
+from datetime import datetime
+
+import data_cache
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONSTANTS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+VERSION = 'version'
+PROVINCES = 'provinces'
+COUNTRIES = 'countries'
+DIGESTS = 'digests'
+DIGEST = 'digest'
+SIZE = 'size'
+NAMES = 'names'
+STARTS = 'starts'
+
+CasesFile = 'cases.npy'
+DeathsFile = 'deaths.npy'
+DatesFile = 'dates.npy'
+KeysFile = 'keys.json'
+StatesFile = 'states.json'
+
+KeyColumns = 4   # Province/State, Country/Region, Lat, Long
+StateColumns = ['date', 'state', 'cases', 'deaths']
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SETTINGS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+ChunkSize = 1 << 20   # bytes of the NYT file parsed at a time
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SNAPSHOT
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class Snapshot():
+    """
+    The loaded snapshot: dates, the memory-mapped cases and deaths matrices,
+    and the Province/State (None when empty) and Country/Region of every row.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, KeysFile)) as f:
+            keys = json.load(f)
+        self.version = keys[VERSION]
+        self.provinces = keys[PROVINCES]
+        self.countries = keys[COUNTRIES]
+        self.digests = keys.get(DIGESTS)
+        self.dates = np.load(os.path.join(directory, DatesFile))
+        self.cases = np.load(os.path.join(directory, CasesFile), mmap_mode='r')
+        self.deaths = np.load(os.path.join(directory, DeathsFile), mmap_mode='r')
+
+    def rows(self, column_values):
+        """
+        Value -> indices of the rows with that value, for self.provinces or self.countries.
+        """
+        rows = {}
+        for row, value in enumerate(column_values):
+            if value is not None:
+                rows.setdefault(value, []).append(row)
+        return rows
+
+    def series(self, rows):
+        """
+        Cumulative cases and deaths summed over rows, only these rows are read.
+        """
+        return self.cases[rows].sum(axis=0, dtype=np.int64), self.deaths[rows].sum(axis=0, dtype=np.int64)
+
+
+def snapshot_version(*urls):
+    return hashlib.sha1(''.join(str(data_cache.version(url)) for url in urls).encode()).hexdigest()[:16]
+
+
+def read_dates(path):
+    with open(path, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f))
+    return np.array([datetime.strptime(x, '%m/%d/%y') for x in header[KeyColumns:]], dtype='datetime64[D]')
+
+
+def read_time_series(path, first=0, digested=()):
+    """
+    Parse one Johns Hopkins file: (keys, dates, values, digests) where keys are
+    (Province/State or None, Country/Region) per row, and values only has the
+    date columns from first on, the ones before are not converted at all.
+    For every number of date columns in digested, digests has the digest of
+    the text of all rows up to that column.
+    """
+    dates = read_dates(path)
+    hashers = [hashlib.sha1() for columns in digested]
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader)
+        keys, values = [], []
+        for line in reader:
+            if len(line) == 0:
+                continue
+            keys.append((line[0] or None, line[1]))
+            for hasher, columns in zip(hashers, digested):
+                hasher.update(','.join(line[:KeyColumns + columns]).encode() + b'\n')
+            values.append([int(float(value)) if value else 0 for value in line[KeyColumns + first:KeyColumns + len(dates)]])
+    values = np.array(values, dtype=np.int64).reshape(len(keys), len(dates) - first)
+    return keys, dates, values, [hasher.hexdigest() for hasher in hashers]
+
+
+def match_rows(keys, other_keys, other_values):
+    """
+    The rows of other_values in the order of keys, zeros where a key is missing.
+    """
+    other_rows = {key: row for row, key in enumerate(other_keys)}
+    values = np.zeros((len(keys), other_values.shape[1]), dtype=other_values.dtype)
+    for row, key in enumerate(keys):
+        if key in other_rows:
+            values[row] = other_values[other_rows[key]]
+    return values
+
+
+def compile_snapshot(confirmed_path, deaths_path, directory, version):
+    """
+    Convert the two downloaded files into a snapshot in directory.
+    The deaths rows are matched to the confirmed rows by key.
+    """
+    days = min(len(read_dates(confirmed_path)), len(read_dates(deaths_path)))
+    keys, dates, cases, cases_digests = read_time_series(confirmed_path, digested=[days])
+    death_keys, death_dates, death_values, deaths_digests = read_time_series(deaths_path, digested=[days])
+    deaths = match_rows(keys, death_keys, death_values)
+    save_snapshot(directory, version, keys, dates[:days], cases[:, :days], deaths[:, :days], cases_digests + deaths_digests)
+
+
+def update_snapshot(snapshot, confirmed_path, deaths_path, directory, version):
+    """
+    Append the new date columns of the two files to snapshot, only these
+    columns are converted. Returns False, without changing anything, when the
+    files changed anywhere else, then the snapshot has to be compiled again.
+    """
+    known = len(snapshot.dates)
+    days = min(len(read_dates(confirmed_path)), len(read_dates(deaths_path)))
+    if snapshot.digests is None or days < known:
+        return False
+
+    keys, dates, cases, cases_digests = read_time_series(confirmed_path, known, [known, days])
+    if cases_digests[0] != snapshot.digests[0] or not np.array_equal(dates[:known], snapshot.dates):
+        return False
+    death_keys, death_dates, death_values, deaths_digests = read_time_series(deaths_path, known, [known, days])
+    if deaths_digests[0] != snapshot.digests[1]:
+        return False
+
+    deaths = match_rows(keys, death_keys, death_values)
+    save_snapshot(directory, version, keys, dates[:days],
+                  np.concatenate([snapshot.cases, cases[:, :days - known]], axis=1),
+                  np.concatenate([snapshot.deaths, deaths[:, :days - known]], axis=1),
+                  [cases_digests[1], deaths_digests[1]])
+    return True
+
+
+def save_snapshot(directory, version, keys, dates, cases, deaths, digests):
+    work = directory + '.tmp'
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+    write_matrices(work, dates, cases, deaths)
+    with open(os.path.join(work, KeysFile), 'w') as f:
+        json.dump({VERSION: version, PROVINCES: [key[0] for key in keys], COUNTRIES: [key[1] for key in keys], DIGESTS: digests}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(work, directory)
+
+
+def write_matrices(directory, dates, cases, deaths):
+    dtype = np.int32 if max(np.abs(cases).max(initial=0), np.abs(deaths).max(initial=0)) < 2**31 else np.int64
+    np.save(os.path.join(directory, DatesFile), dates)
+    np.save(os.path.join(directory, CasesFile), np.ascontiguousarray(cases, dtype=dtype))
+    np.save(os.path.join(directory, DeathsFile), np.ascontiguousarray(deaths, dtype=dtype))
+
+
+def global_snapshot(confirmed_url, deaths_url, ttl=None):
+    """
+    The Snapshot of the current Johns Hopkins files, updated or compiled
+    again when the downloaded files are newer than the snapshot.
+    """
+    confirmed_path, deaths_path = data_cache.fetch_many([confirmed_url, deaths_url], ttl)
+    version = snapshot_version(confirmed_url, deaths_url)
+    directory = os.path.join(data_cache.CacheDirectory, 'snapshot-' + hashlib.sha1((confirmed_url + deaths_url).encode()).hexdigest()[:10])
+
+    snapshot = None
+    try:
+        snapshot = Snapshot(directory)
+        if snapshot.version == version:
+            return snapshot
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if snapshot is None or not update_snapshot(snapshot, confirmed_path, deaths_path, directory, version):
+        compile_snapshot(confirmed_path, deaths_path, directory, version)
+    return Snapshot(directory)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# STATES -- the NYT file split by state
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def read_states(path, start, states):
+    """
+    Parse the rows of the NYT file from byte start on and append them to
+    states, {state: (dates, cumulative cases, cumulative deaths)}.
+    Returns the states with new rows, and where the last row ends, the last
+    row of the file counts also without a newline at the end.
+    The file is read ChunkSize bytes at a time, straight into typed arrays
+    per state, so only the result has to fit in memory, not the file.
+    """
+    rows = {}     # state -> (days since 1970, cases, deaths) as array('q')
+    days = {}     # date -> days since 1970
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]))
+        columns = [header.index(name) for name in StateColumns]
+        f.seek(max(start, f.tell()))
+        end = f.tell()
+        rest = b''
+        while True:
+            data = f.read(ChunkSize)
+            last = len(data) == 0
+            data = rest + data
+            complete = len(data) if last else data.rfind(b'\n') + 1
+            rest = data[complete:]
+            end += complete
+
+            for line in csv.reader(data[:complete].decode('utf-8').splitlines()):
+                if len(line) == 0:
+                    continue
+                date, state, cases, deaths = [line[column] for column in columns]
+                if date not in days:
+                    days[date] = int(np.datetime64(date, 'D').astype(np.int64))
+                if state not in rows:
+                    rows[state] = (array('q'), array('q'), array('q'))
+                state_dates, state_cases, state_deaths = rows[state]
+                state_dates.append(days[date])
+                state_cases.append(int(cases or 0))
+                state_deaths.append(int(deaths or 0))
+
+            if last:
+                break
+
+    for state, (dates, cases, deaths) in rows.items():
+        new = (np.frombuffer(dates, dtype=np.int64).astype('datetime64[D]'),
+               np.frombuffer(cases, dtype=np.int64).copy(), np.frombuffer(deaths, dtype=np.int64).copy())
+        if state in states:
+            new = tuple(np.concatenate([old, values]) for old, values in zip(states[state], new))
+        states[state] = new
+    return set(rows), end
+
+
+def load_states(directory):
+    """
+    The saved states and what is known about the file they came from, ({}, {}) if none.
+    """
+    try:
+        with open(os.path.join(directory, StatesFile)) as f:
+            info = json.load(f)
+        dates = np.load(os.path.join(directory, DatesFile))
+        cases = np.load(os.path.join(directory, CasesFile))
+        deaths = np.load(os.path.join(directory, DeathsFile))
+    except (OSError, ValueError):
+        return {}, {}
+    bounds = info[STARTS] + [len(dates)]
+    states = {name: (dates[start:end], cases[start:end], deaths[start:end])
+              for name, start, end in zip(info[NAMES], bounds[:-1], bounds[1:])}
+    return states, info
+
+
+def save_states(directory, states, info):
+    names = list(states)
+    starts = np.cumsum([0] + [len(states[name][0]) for name in names[:-1]]).tolist()
+    work = directory + '.tmp'
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+    for index, name in enumerate([DatesFile, CasesFile, DeathsFile]):
+        np.save(os.path.join(work, name), np.concatenate([states[state][index] for state in names]))
+    with open(os.path.join(work, StatesFile), 'w') as f:
+        json.dump(dict(info, **{NAMES: names, STARTS: starts}), f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(work, directory)
+
+
+def state_tables(url, ttl=None):
+    """
+    The NYT file split by state, {state: (dates, cumulative cases, cumulative deaths)},
+    and the set of states that got new rows. The download only asks for what
+    was added to the file, and when the part read last time did not change,
+    only the rows after it are parsed.
+    """
+    path = data_cache.fetch(url, ttl, append=True)
+    version = data_cache.version(url)
+    directory = os.path.join(data_cache.CacheDirectory, 'states-' + hashlib.sha1(url.encode()).hexdigest()[:10])
+
+    states, info = load_states(directory)
+    if info.get(VERSION) == version:
+        return states, set()
+
+    start = info.get(SIZE, 0)
+    if start == 0 or start > os.path.getsize(path) or data_cache.file_digest(path, start) != info.get(DIGEST):
+        states, start = {}, 0
+
+    changed, size = read_states(path, start, states)
+    save_states(directory, states, {VERSION: version, SIZE: size, DIGEST: data_cache.file_digest(path, size)})
+    return states, changed
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# MAIN -- compile the snapshot ahead of time
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+if __name__ == "__main__":
+
+    import plot_covid
+
+    snapshot = global_snapshot(plot_covid.GlobalDataLocation + plot_covid.ConfirmedFile,
+                               plot_covid.GlobalDataLocation + plot_covid.DeathsFile)
+    print(snapshot.cases.shape[0], "locations,", snapshot.cases.shape[1], "days, up to", snapshot.dates[-1])
+    states, changed = state_tables(plot_covid.StateDataLocation + plot_covid.StateFile)
+    print(len(states), "states,", len(changed), "with new rows")
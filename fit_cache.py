@@ -0,0 +1,146 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# FIT CACHE -- keep the covid_curve fits of series that were fitted before
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+On-disk cache of fitted covid_curve models, so a series that was fitted
+before, in this run, an earlier one or another process, is not fitted again.
+
+A fit is stored under a digest of what it was fitted to: the days, the values
+and the initial guess. Each fit is a small file with the parameters and their
+covariance, or an empty file for a fit that did not converge. The modification
+time of the file is its last use, when there are more than Size files the
+least recently used ones are removed. The files are counted once per process
+and then kept count of, the directory is only listed again for a trim, which
+leaves room for Size / 8 new fits before the next one.
+Every get returns new arrays, a caller can change them without changing the cache.
+"""
+
+
+import os
+import hashlib
+
+import numpy as np
+
+import data_cache
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONSTANTS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+PARAMETERS = 4   # offset, top, curve, slope
+
+HITS = 'hits'
+MISSES = 'misses'
+STORES = 'stores'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SETTINGS -- can be changed through the environment
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+Size = int(os.environ.get('COVID_FIT_CACHE_SIZE', 4096))   # fits kept, 0 turns the cache off
+Directory = 'fits'   # in data_cache.CacheDirectory
+
+Statistics = {HITS: 0, MISSES: 0, STORES: 0}
+
+Files = None   # fits on disk, counted on the first put, as far as this process knows
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CACHE
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def fit_key(xvalues, values, p0):
+    """
+    Digest of the input of a fit.
+    """
+    digest = hashlib.sha1(np.asarray(xvalues, dtype=np.float64).tobytes())
+    digest.update(np.asarray(values, dtype=np.float64).tobytes())
+    digest.update(np.asarray(p0, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:20]
+
+
+def fit_path(key):
+    return os.path.join(data_cache.CacheDirectory, Directory, key + '.fit')
+
+
+def get(key):
+    """
+    The fit stored for key: (popt, pcov), (None, None) for a fit that did
+    not converge, or None when there is none.
+    """
+    if Size <= 0:
+        return None
+    path = fit_path(key)
+    try:
+        stored = np.fromfile(path, dtype=np.float64)
+        os.utime(path)   # used now
+    except (OSError, ValueError):
+        Statistics[MISSES] += 1
+        return None
+    if len(stored) == 0:
+        Statistics[HITS] += 1
+        return None, None
+    if len(stored) != PARAMETERS + PARAMETERS * PARAMETERS:
+        Statistics[MISSES] += 1
+        return None
+    Statistics[HITS] += 1
+    return stored[:PARAMETERS].copy(), stored[PARAMETERS:].reshape(PARAMETERS, PARAMETERS).copy()
+
+
+def put(key, popt, pcov):
+    """
+    Store a fit, popt None for a fit that did not converge.
+    """
+    global Files
+    if Size <= 0:
+        return
+    path = fit_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if Files is None:
+        Files = len(fit_names())
+    if not os.path.exists(path):
+        Files += 1
+    stored = np.empty(0) if popt is None else np.concatenate([np.ravel(popt), np.ravel(pcov)])
+    stored.astype(np.float64).tofile(path + '.' + str(os.getpid()))
+    os.replace(path + '.' + str(os.getpid()), path)
+    Statistics[STORES] += 1
+    if Files > Size:
+        trim(Size - Size // 8)
+
+
+def fit_names():
+    try:
+        return [name for name in os.listdir(os.path.join(data_cache.CacheDirectory, Directory)) if name.endswith('.fit')]
+    except OSError:
+        return []
+
+
+def trim(size=None):
+    """
+    Remove the least recently used fits until at most size are left.
+    """
+    global Files
+    size = Size if size is None else size
+    directory = os.path.join(data_cache.CacheDirectory, Directory)
+    names = fit_names()
+    Files = min(len(names), size)
+    if len(names) <= size:
+        return
+
+    used = []
+    for name in names:
+        try:
+            used.append((os.path.getmtime(os.path.join(directory, name)), name))
+        except OSError:
+            pass
+    for mtime, name in sorted(used)[:len(used) - size]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
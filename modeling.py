@@ -0,0 +1,238 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# MODELING -- the effective reproduction number R(t), and lethality
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+R(t), the number of people one infected person infects, estimated from daily
+cases with the method of Cori et al., Am J Epidemiol 178 (2013) 1505-1512.
+
+New cases on a day are caused by the cases of the days before, each weighted
+by the serial interval: how many days after the primary case a secondary case
+shows up. With the infectiousness Lambda(t) = sum over s of cases(t - s) w(s),
+R(t) over a window of days ending at t is the posterior of a Gamma prior:
+
+    R(t) = (PriorShape + sum of cases) / (1 / PriorScale + sum of Lambda)
+
+Everything works on a (locations x days) array: Lambda is one FFT convolution
+of all rows, the window sums are differences of cumulative sums. The credible
+interval uses the Wilson-Hilferty approximation of the Gamma quantiles, with
+at least MinimumCases cases it is within 0.1% of the exact quantiles.
+
+Lethality: deaths are modeled as a fraction, the fatality rate, of the cases
+some days earlier, spread by a lag distribution:
+
+    deaths(t) = fatality * sum over s of cases(t - s) g(s)
+
+where g is a gamma distribution with a mean of lag days. For every location and
+every lag in LagGrid the fatality is a least-squares fit, the lag with the
+smallest residual is the estimate. The convolutions for all lags are done in
+one FFT, the least squares as sums over arrays of all locations and lags.
+"""
+
+
+import math
+
+import numpy as np
+
+from statistics import NormalDist
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONSTANTS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+RT = 'rt'
+LOW = 'low'
+HIGH = 'high'
+
+FATALITY = 'fatality'
+FATALITY_LOW = 'fatality-low'
+FATALITY_HIGH = 'fatality-high'
+LAG = 'lag'
+LAG_LOW = 'lag-low'
+LAG_HIGH = 'lag-high'
+EXPECTED = 'expected'
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SETTINGS
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+# serial interval: a gamma distribution, Nishiura et al., Int J Infect Dis 93 (2020) 284-286
+
+SerialIntervalMean = 4.7   # days
+SerialIntervalSD = 2.9     # days
+SerialIntervalDays = 21    # longest serial interval taken into account
+
+Window = 7           # days in the window of each estimate
+PriorShape = 1.0     # Gamma prior of R, mean 5 and sd 5, as in Cori et al.
+PriorScale = 5.0
+MinimumCases = 12    # cases in a window needed for an estimate
+Interval = 0.95      # credible interval of LOW and HIGH, and the confidence intervals of lethality
+
+# lag from a reported case to a death: a gamma distribution with this coefficient
+# of variation, as the onset to death time in Verity et al., Lancet Infect Dis 20 (2020) 669-677
+
+LagGrid = np.arange(1, 41)   # mean lags that are tried, days
+LagCV = 0.45
+Chunk = 64                   # locations per FFT, keeps the memory bounded
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# R(t)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def discretized_gamma(mean, sd, days, first=0):
+    """
+    Gamma distribution on whole days: w[s] is the probability of s days,
+    rounded, where less than first days counts as first. Sums to 1.
+    """
+    shape, scale = (mean / sd) ** 2, sd * sd / mean
+    steps = 100   # per day, to integrate the density
+    t = (np.arange((days + 0.5) * steps) + 0.5) / steps
+    density = np.exp((shape - 1) * np.log(t) - t / scale - math.lgamma(shape) - shape * math.log(scale))
+    weights = np.bincount(np.clip(np.rint(t), first, days).astype(int), weights=density, minlength=days + 1)
+    return weights / weights.sum()
+
+
+def serial_interval(mean=None, sd=None, days=None):
+    """
+    Discretized serial interval: w[s] is the probability that it is s days,
+    w[0] is 0.
+    """
+    mean = SerialIntervalMean if mean is None else mean
+    sd = SerialIntervalSD if sd is None else sd
+    days = SerialIntervalDays if days is None else days
+    return discretized_gamma(mean, sd, days, first=1)
+
+
+def convolve(rows, kernels):
+    """
+    Every row convolved with every kernel, as one FFT: (rows x kernels x days),
+    the days of rows, each the sum over s of row(t - s) * kernel[s].
+    """
+    rows, kernels = np.atleast_2d(rows), np.atleast_2d(kernels)
+    days = rows.shape[1]
+    size = 1 << (days + kernels.shape[1] - 2).bit_length()   # no wrap-around
+    spectrum = np.fft.rfft(rows, size, axis=1)[:, np.newaxis, :] * np.fft.rfft(kernels, size, axis=1)[np.newaxis, :, :]
+    return np.maximum(np.fft.irfft(spectrum, size, axis=2)[:, :, :days], 0.0)
+
+
+def infectiousness(incidence, weights):
+    """
+    Lambda(t) = sum over s of incidence(t - s) * weights[s], for every row of incidence.
+    """
+    return convolve(incidence, weights)[:, 0, :]
+
+
+def window_sums(values, window):
+    """
+    Sum of the window days up to and including each day, along the rows.
+    """
+    sums = np.cumsum(values, axis=1)
+    sums[:, window:] -= sums[:, :-window].copy()
+    return sums
+
+
+def reproduction_number(cases, window=None, weights=None):
+    """
+    R(t) for daily cases, one location or a (locations x days) array.
+    Returns arrays shaped like cases: RT, the posterior mean, and LOW and HIGH,
+    the credible interval. Days without an estimate, the first window days
+    and windows with fewer than MinimumCases cases, are NaN.
+    """
+    window = Window if window is None else window
+    weights = serial_interval() if weights is None else weights
+    incidence = np.maximum(np.nan_to_num(np.asarray(cases, dtype=float)), 0.0)
+    shape_of_cases = incidence.shape
+    incidence = np.atleast_2d(incidence)
+
+    cases_sum = window_sums(incidence, window)
+    pressure_sum = window_sums(infectiousness(incidence, weights), window)
+    shape = PriorShape + cases_sum
+    rate = 1.0 / PriorScale + pressure_sum
+
+    valid = (cases_sum >= MinimumCases) & (np.arange(incidence.shape[1]) >= window)
+    result = {RT: shape / rate,
+              LOW: gamma_quantile(shape, (1 - Interval) / 2) / rate,
+              HIGH: gamma_quantile(shape, (1 + Interval) / 2) / rate}
+    return {key: np.where(valid, value, np.nan).reshape(shape_of_cases) for key, value in result.items()}
+
+
+def gamma_quantile(shape, probability):
+    """
+    Quantile of the Gamma distribution with scale 1, Wilson-Hilferty approximation.
+    """
+    z = NormalDist().inv_cdf(probability)
+    return shape * np.maximum(1 - 1 / (9 * shape) + z / (3 * np.sqrt(shape)), 0.0) ** 3
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# LETHALITY
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def lag_kernels(lags=None):
+    """
+    The lag distribution for every mean lag, a row each.
+    """
+    lags = LagGrid if lags is None else np.asarray(lags)
+    days = int(np.max(lags) * (1 + 4 * LagCV))
+    return np.array([discretized_gamma(lag, LagCV * lag, days) for lag in lags])
+
+
+def lethality(cases, deaths, lags=None):
+    """
+    Fatality rate and lag of deaths after cases, for one location or
+    (locations x days) arrays. Returns an array per key, a value per location:
+    FATALITY and LAG, with their confidence intervals FATALITY_LOW,
+    FATALITY_HIGH, LAG_LOW and LAG_HIGH, and EXPECTED, the deaths the model
+    gives for the cases, shaped like deaths. NaN where there is no model.
+    The intervals assume independent errors, so they are on the narrow side.
+    """
+    lags = LagGrid if lags is None else np.asarray(lags)
+    single = np.ndim(cases) == 1
+    cases = np.maximum(np.nan_to_num(np.atleast_2d(np.asarray(cases, dtype=float))), 0.0)
+    deaths = np.maximum(np.nan_to_num(np.atleast_2d(np.asarray(deaths, dtype=float))), 0.0)
+    kernels = lag_kernels(lags)
+    start = min(int(np.max(lags)), cases.shape[1] // 4)   # the days before have too little history
+    used = cases.shape[1] - start
+    z = NormalDist().inv_cdf((1 + Interval) / 2)
+
+    result = {key: np.full(len(cases), np.nan) for key in [FATALITY, FATALITY_LOW, FATALITY_HIGH, LAG, LAG_LOW, LAG_HIGH]}
+    result[EXPECTED] = np.full(deaths.shape, np.nan)
+
+    for first in range(0, len(cases), Chunk):
+        rows = slice(first, first + Chunk)
+        predictors = convolve(cases[rows], kernels)
+        x, y = predictors[:, :, start:], deaths[rows, start:]
+
+        with np.errstate(all='ignore'):
+            xy = np.einsum('lgt,lt->lg', x, y)
+            xx = np.einsum('lgt,lgt->lg', x, x)
+            yy = np.einsum('lt,lt->l', y, y)
+            fatality = xy / xx
+            residual = np.maximum(yy[:, np.newaxis] - xy * fatality, 1e-12)
+            residual[~np.isfinite(fatality) | (yy[:, np.newaxis] == 0)] = np.inf
+
+            best = np.argmin(residual, axis=1)
+            number = np.arange(len(best))
+            found = np.isfinite(residual[number, best])
+            error = np.sqrt(residual[number, best] / (used - 1) / xx[number, best])
+            # likelihood ratio: the lags that do not fit significantly worse than the best one
+            within = used * np.log(residual / residual[number, best][:, np.newaxis]) <= z * z
+
+        lag_low = lags[np.argmax(within, axis=1)]
+        lag_high = lags[len(lags) - 1 - np.argmax(within[:, ::-1], axis=1)]
+        chosen = fatality[number, best]
+        for key, value in [(FATALITY, chosen), (FATALITY_LOW, chosen - z * error), (FATALITY_HIGH, chosen + z * error),
+                           (LAG, lags[best]), (LAG_LOW, lag_low), (LAG_HIGH, lag_high)]:
+            result[key][rows] = np.where(found, value, np.nan)
+        result[EXPECTED][rows] = np.where(found[:, np.newaxis], chosen[:, np.newaxis] * predictors[number, best], np.nan)
+
+    if single:
+        return {key: value[0] for key, value in result.items()}
+    return result
@@ -5,22 +5,33 @@
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
+import os
+import io
+import re
 import sys
+import json
 import math
-import matplotlib
-matplotlib.use("Qt5Agg")
+import shutil
+import time
+import pstats
+import cProfile
+import hashlib
+import zlib
+import contextlib
+import tracemalloc
 
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 
-from scipy.optimize import curve_fit
+# matplotlib, scipy, iso3166 and the process pools are imported where they are
+# used, a noplot query on cached data never loads them and starts much faster
 
-# https://stackoverflow.com/questions/41245330/check-if-a-country-entered-is-one-of-the-countries-of-the-world
-
-from iso3166 import countries as Countries
 from us_states import states as States
-from datetime import datetime
+from regions import regions as Regions
+
+import data_cache
+import data_store
+import fit_cache
+import modeling
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -29,11 +40,21 @@ from datetime import datetime
 
 
 LOCATION = 'location'
+LOCATIONS = 'locations'
 
 PDF = 'pdf'
+PNG = 'png'
+SVG = 'svg'
+HEADLESS = 'headless'
 XKCD = 'xkcd'
 INFO = 'info'
 PLOT = 'plot'
+REFRESH = 'refresh'
+BATCH = 'batch'
+VERBOSE = 'verbose'
+PROFILE = 'profile'
+PROFILEJSON = 'profile-json'
+CPROFILE = 'cprofile'
 
 NAME = 'name'
 ABBREVIATION = 'abbreviation'
@@ -42,16 +63,47 @@ STATE = 'state'
 DEATHS = 'deaths'
 CASES = 'cases'
 DATE = 'date'
+XVALUES = 'xvalues'
 FAMILY = 'family'
 SERIF = 'serif'
 
 LASTDAY = 'last-day'
+TOTALCASES = 'total-cases'
+TOTALDEATHS = 'total-deaths'
 STARTDATE = 'start-date'
 
 COUNTRY_REGION = 'Country/Region'
 PROVINCE_STATE = 'Province/State'
 
 YLIMIT = 'y-limit'
+WORKERS = 'workers'
+PERPAGE = 'per-page'
+GRID = 'grid'
+WARM = 'warm'
+FORECAST = 'forecast'
+RT = 'rt'
+LETHALITY = 'lethality'
+REPORT = 'report'
+
+PEAK = 'peak'
+SOFAR = 'so-far'
+COMING = 'coming'
+TOTAL = 'total'
+
+STAGE = 'stage'
+PARENT = 'parent'
+WALL = 'wall'
+CPU = 'cpu'
+MEMORY = 'memory'
+NETWORK = 'network'
+BYTES = 'bytes'
+EVALUATIONS = 'evaluations'
+FAILED = 'failed'
+FIT_HITS = 'fit-hits'
+FIT_MISSES = 'fit-misses'
+FIT_STORES = 'fit-stores'
+
+FitCounts = {FIT_HITS: fit_cache.HITS, FIT_MISSES: fit_cache.MISSES, FIT_STORES: fit_cache.STORES}   # profile -> fit_cache.Statistics
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -141,6 +193,21 @@ West Bank and Gaza -> Palestine, State of
 """
 
 
+# named sets of locations for batch runs
+
+STATES_SET = 'states'
+COUNTRIES_SET = 'countries'
+
+LocationSets = { 'states': STATES_SET,
+                 'us states': STATES_SET,
+                 'all states': STATES_SET,
+                 'all us states': STATES_SET,
+                 'countries': COUNTRIES_SET,
+                 'all countries': COUNTRIES_SET,
+                 'jhu countries': COUNTRIES_SET,
+               }
+
+
 PlotExceptions = { 'Korea, South': 'South Korea',
                    'Taiwan*': 'Taiwan',
                    'US-NY': "US except for NY",
@@ -148,164 +215,757 @@ PlotExceptions = { 'Korea, South': 'South Korea',
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-# DATA
+# PROFILE -- per-stage measurements, only when asked for
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
-def get_data(parameters):
+ProfileFile = 'covid-profile.json'
+Profiler = None                  # the StageProfiler while profiling
+NoStage = contextlib.nullcontext()
+
+
+def stage(name, location=None):
     """
-    Look up data for location.
-    Location can be US states: MA, Ohio, NY, New Jersey, etc. abreviation or full name
-    Location can also be country or province, or some common abbreviation
-    US states get precedence for abreviations, i.e. CA is California, not Canada
+    Context manager that measures what happens inside as stage name, for
+    location, while profiling. Otherwise it does nothing at all.
     """
-    global States, Countries
+    if Profiler is None:
+        return NoStage
+    return Profiler.stage(name, location)
 
-    alternatives = []
-    location = parameters[LOCATION]
-    startdate = parameters.get(STARTDATE, '2020-03-15')
 
-    if location.islower():
-        location = location.upper() if len(location) < 4 else location.capitalize()
+def count_evaluations(evaluations):
+    """
+    Add the function evaluations of one curve_fit, None when it failed.
+    """
+    if Profiler is not None:
+        for record in Profiler.stack:
+            if evaluations is None:
+                record[FAILED] += 1
+            else:
+                record[EVALUATIONS] += evaluations
+
+
+class StageProfiler():
+    """
+    Wall time, CPU time, peak memory, time and bytes on the network, fits
+    found in, missing from and stored to the fit cache, and curve_fit
+    evaluations of every stage. A nested stage is also part of the stages
+    around it. Memory is traced with tracemalloc, which makes everything a
+    bit slower while profiling. One stage can also be run under cProfile.
+    Fits done by worker processes only show up as wall time.
+    """
 
-    if location == 'US-NY':
+    def __init__(self, cprofile=None):
+        self.records = []
+        self.stack = []
+        self.cprofile = cprofile
+        self.profile = cProfile.Profile() if cprofile else None
+        self.profiled = False   # whether the cprofile stage ever ran
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, location=None):
+        record = {STAGE: name, LOCATION: location, PARENT: self.stack[-1][STAGE] if self.stack else None, EVALUATIONS: 0, FAILED: 0}
+        memory, peak = tracemalloc.get_traced_memory()
+        for item in self.stack:   # tracemalloc has only one peak
+            item[PEAK] = max(item[PEAK], peak)
+        tracemalloc.reset_peak()
+        record[PEAK] = memory
+        network = (data_cache.Statistics[data_cache.SECONDS], data_cache.Statistics[data_cache.BYTES])
+        fits = dict(fit_cache.Statistics)
+        profiling = name == self.cprofile and all(item[STAGE] != name for item in self.stack)
+        if profiling:
+            self.profile.enable()
+            self.profiled = True
+        self.stack.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record[WALL] = time.perf_counter() - wall
+            record[CPU] = time.process_time() - cpu
+            self.stack.pop()
+            if profiling:
+                self.profile.disable()
+            peak = max(record.pop(PEAK), tracemalloc.get_traced_memory()[1])
+            for item in self.stack:
+                item[PEAK] = max(item[PEAK], peak)
+            record[MEMORY] = peak - memory
+            record[NETWORK] = data_cache.Statistics[data_cache.SECONDS] - network[0]
+            record[BYTES] = data_cache.Statistics[data_cache.BYTES] - network[1]
+            for key, counter in FitCounts.items():
+                record[key] = fit_cache.Statistics[counter] - fits[counter]
+            self.records.append(record)
+
+    def totals(self):
+        """
+        Per stage: how often it ran, and the sums, or for memory the maximum.
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record[STAGE], {STAGE: record[STAGE], 'count': 0, WALL: 0.0, CPU: 0.0, MEMORY: 0,
+                                                      NETWORK: 0.0, BYTES: 0, FIT_HITS: 0, FIT_MISSES: 0, FIT_STORES: 0,
+                                                      EVALUATIONS: 0, FAILED: 0})
+            total['count'] += 1
+            total[MEMORY] = max(total[MEMORY], record[MEMORY])
+            for key in [WALL, CPU, NETWORK, BYTES, FIT_HITS, FIT_MISSES, FIT_STORES, EVALUATIONS, FAILED]:
+                total[key] += record[key]
+        return list(totals.values())
+
+
+def start_profile(cprofile=None):
+    global Profiler
+    Profiler = StageProfiler(cprofile)
+
+
+def print_profile(write_json=False):
+    """
+    Print the totals per stage, and the cProfile statistics when there are any.
+    With write_json, also write all measurements to ProfileFile.
+    """
+    totals = Profiler.totals()
+    line = '{0:<10} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9} {6:>11} {7:>8} {8:>8} {9:>8} {10:>11} {11:>6}'
+    print()
+    print(line.format('Stage', 'Count', 'Wall s', 'CPU s', 'Peak MB', 'Network s', 'Bytes', 'Fit hits', 'Misses', 'Stored', 'Evaluations', 'Failed'))
+    for total in totals:
+        print(line.format(total[STAGE], total['count'], '%.3f' % total[WALL], '%.3f' % total[CPU], '%.1f' % (total[MEMORY] / 2**20),
+                          '%.3f' % total[NETWORK], total[BYTES], total[FIT_HITS], total[FIT_MISSES], total[FIT_STORES],
+                          total[EVALUATIONS], total[FAILED]))
+
+    if write_json:
+        with open(ProfileFile, 'w') as f:
+            json.dump({'totals': totals, 'records': Profiler.records}, f, indent=1)
+        print("Profile written to", ProfileFile)
+
+    if Profiler.profiled:
+        print()
+        pstats.Stats(Profiler.profile).sort_stats('cumulative').print_stats(20)
+    elif Profiler.profile is not None:
+        print()
+        print("Stage", Profiler.cprofile, "did not run, nothing for cProfile.")
 
-        parameters.update({LOCATION: 'US'})
-        us_cases, us_deaths, us_xvalues = get_data(parameters)
-        parameters.update({LOCATION: 'NY'})
-        ny_cases, ny_deaths, ny_xvalues = get_data(parameters)
-        parameters.update({LOCATION: location})
 
-        return us_cases - ny_cases, us_deaths - ny_deaths, us_xvalues
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DATASET -- every source file is parsed only once per process
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-    if location in States:   # US States
 
-        state = States[location]
-        location = state[NAME]
-        alternatives = [state[ABBREVIATION]]
+class Dataset():
+    """
+    Parsed NYT and Johns Hopkins tables, loaded the first time they are needed.
+    The Johns Hopkins data comes from the memory-mapped snapshot of data_store.
+    The per-location series are kept in dictionaries, so every lookup after
+    the first one is a dictionary lookup instead of a parse and a table scan.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.states = None              # state name -> (dates, cumulative cases, cumulative deaths)
+        self.snapshot = None            # data_store.Snapshot of the Johns Hopkins files
+        self.global_dates = None        # dates of the Johns Hopkins columns
+        self.countries = None           # Country/Region -> row indices in the Johns Hopkins files
+        self.provinces = None           # Province/State -> row indices
+        self.country_provinces = None   # Country/Region -> Province/State of each of its rows
+        self.rows = None                # column -> location -> row indices
+        self.global_cache = {}          # (column, location) -> (cumulative cases, cumulative deaths)
+        self.state_table = None         # (names, dates, cumulative cases, cumulative deaths) of all states on one date index
+        self.region_cache = {}          # terms -> (dates, cumulative cases, cumulative deaths)
+        self.index = None
+        self.fetched = set()            # urls revalidated by prefetch, not again when loaded
+
+    def prefetch(self, states=True, countries=True, ttl=None):
+        """
+        Fetch the NYT file and the Johns Hopkins files, as far as they are
+        needed, at the same time instead of one after the other when loaded.
+        """
+        urls = ([StateDataLocation + StateFile] if states else []) + \
+               ([GlobalDataLocation + ConfirmedFile, GlobalDataLocation + DeathsFile] if countries else [])
+        data_cache.fetch_many(urls, self.ttl if ttl is None else ttl, append=[StateDataLocation + StateFile])
+        self.fetched.update(urls)
+
+    def file_ttl(self, url):
+        return math.inf if url in self.fetched else self.ttl
+
+    def load_states(self):
+        if self.states is None:
+            with stage('states'):
+                url = StateDataLocation + StateFile
+                self.states = data_store.state_tables(url, self.file_ttl(url))[0]
+        return self.states
+
+    def load_global(self, snapshot=None):
+        if self.countries is None:
+            if snapshot is None:
+                with stage('global'):
+                    url = GlobalDataLocation + ConfirmedFile
+                    snapshot = data_store.global_snapshot(url, GlobalDataLocation + DeathsFile, self.file_ttl(url))
+            self.snapshot = snapshot
+            self.global_dates = snapshot.dates
+            self.countries = snapshot.rows(snapshot.countries)
+            self.provinces = snapshot.rows(snapshot.provinces)
+            self.rows = {COUNTRY_REGION: self.countries, PROVINCE_STATE: self.provinces}
+            self.country_provinces = {country: [snapshot.provinces[row] for row in rows] for country, rows in self.countries.items()}
+        return self.countries
+
+    def update(self):
+        """
+        Revalidate the data files that were loaded and bring the tables up to
+        date, only the new rows and date columns are parsed. What was derived
+        from locations without new data is kept, returns the names of the
+        locations with new data.
+        """
+        changed = set()
+        self.prefetch(self.states is not None, self.snapshot is not None, ttl=0)
+        if self.states is not None:
+            self.states, states = data_store.state_tables(StateDataLocation + StateFile, math.inf)
+            changed.update(states)
+            if len(states) > 0:
+                self.state_table = None
+        if self.snapshot is not None:
+            snapshot = data_store.global_snapshot(GlobalDataLocation + ConfirmedFile, GlobalDataLocation + DeathsFile, math.inf)
+            if snapshot.version != self.snapshot.version:
+                changed.update(self.countries)   # every row has the new days
+                changed.update(self.provinces)
+                self.countries = None
+                self.global_cache = {}
+                self.index = None
+                self.load_global(snapshot)
+        if len(changed) > 0:
+            self.region_cache = {}
+        return changed
+
+    def state_series(self, name):
+        return self.load_states().get(name)
+
+    def state_matrix(self):
+        """
+        All states on one date index: (names, dates, cases, deaths) with one
+        row of cumulative numbers per state, 0 before its first day.
+        """
+        if self.state_table is None:
+            states = self.load_states()
+            names = list(states)
+            dates = np.arange(min(states[name][0][0] for name in names), max(states[name][0][-1] for name in names) + 1)
+            cases = np.array([align_cumulative(states[name][0], states[name][1], dates) for name in names])
+            deaths = np.array([align_cumulative(states[name][0], states[name][2], dates) for name in names])
+            self.state_table = (names, dates, cases, deaths)
+        return self.state_table
+
+    def region_series(self, terms):
+        """
+        Dates and cumulative (cases, deaths) of a sum of locations, terms are
+        (coefficient, column, location). The Johns Hopkins rows and the states
+        are each reduced with one product of a coefficient vector and their
+        matrix, then both are added on a common date index: from the first
+        date of either to the last date of both.
+        """
+        key = tuple(sorted(terms))
+        if key not in self.region_cache:
+            parts = []
+            global_terms = [term for term in terms if term[1] != STATE]
+            state_terms = [term for term in terms if term[1] == STATE]
+
+            if len(global_terms) > 0:
+                self.load_global()
+                coefficients = np.zeros(len(self.snapshot.countries), dtype=np.int64)
+                for coefficient, column, name in global_terms:
+                    np.add.at(coefficients, self.rows[column][name], coefficient)
+                rows = np.flatnonzero(coefficients)
+                parts.append((self.global_dates, coefficients[rows] @ self.snapshot.cases[rows], coefficients[rows] @ self.snapshot.deaths[rows]))
+
+            if len(state_terms) > 0:
+                names, dates, cases, deaths = self.state_matrix()
+                coefficients = np.zeros(len(names), dtype=np.int64)
+                for coefficient, column, name in state_terms:
+                    coefficients[names.index(name)] += coefficient
+                parts.append((dates, coefficients @ cases, coefficients @ deaths))
+
+            dates = np.arange(min(part[0][0] for part in parts), min(part[0][-1] for part in parts) + 1)
+            self.region_cache[key] = (dates,
+                                      sum(align_cumulative(part[0], part[1], dates) for part in parts),
+                                      sum(align_cumulative(part[0], part[2], dates) for part in parts))
+        return self.region_cache[key]
+
+    def global_series(self, column, name):
+        """
+        Cumulative (cases, deaths) of all rows of name in column, only
+        these rows of the snapshot are read, and only the first time.
+        """
+        key = (column, name)
+        if key not in self.global_cache:
+            self.load_global()
+            rows = self.rows[column].get(name)
+            if rows is None:
+                return None
+            self.global_cache[key] = self.snapshot.series(rows)
+        return self.global_cache[key]
+
+    def index_version(self):
+        """
+        Changes with the Johns Hopkins files and with the tables of names in this file.
+        """
+        tables = repr((sorted(States), sorted(LocationExceptions.items()), sorted(CountryExceptions.items())))
+        return [data_cache.version(GlobalDataLocation + ConfirmedFile),
+                data_cache.version(GlobalDataLocation + DeathsFile),
+                hashlib.sha1(tables.encode()).hexdigest()]
+
+    def location_index(self):
+        """
+        The LocationIndex, read from next to the data cache when it is still
+        valid, otherwise built from the Johns Hopkins files and saved there.
+        """
+        if self.index is None:
+            path = os.path.join(data_cache.CacheDirectory, IndexFile)
+            index = LocationIndex.load(path)
+            if index is not None and None not in index.version and index.version == self.index_version():
+                self.index = index
+            else:
+                with stage('index'):
+                    self.index = LocationIndex.build(self)
+                os.makedirs(data_cache.CacheDirectory, exist_ok=True)
+                self.index.save(path)
+        return self.index
 
-        df = pd.read_csv(StateDataLocation + StateFile)
-        rows = df[STATE] == location
 
-        cumul_deaths = df[rows][DEATHS].tolist()
-        cumul_cases = df[rows][CASES].tolist()
-        dates = df[rows][DATE].tolist()
-        parameters[LASTDAY] = dates[-1]
+Data = None
 
-        since_startdate =  np.where(np.array(dates) >= startdate)
-        cumul_deaths = np.array(cumul_deaths)[since_startdate]
-        cumul_cases = np.array(cumul_cases)[since_startdate]
-        dates = np.array(dates)[since_startdate]
 
-        daily_cases = [0] + list(np.array(cumul_cases)[1:] - np.array(cumul_cases)[:-1])
-        daily_deaths = [0] + list(np.array(cumul_deaths)[1:] - np.array(cumul_deaths)[:-1])
-        xvalues = [x for x in range(- len(daily_deaths) + 1, 1)]
+def load_dataset(refresh=False):
+    """
+    The Dataset of this process, created on first use.
+    With refresh, the data files are revalidated and the Dataset is updated.
+    """
+    global Data
+    if Data is None:
+        Data = Dataset(ttl=0 if refresh else None)
+    elif refresh:
+        Data.update()
+    return Data
 
-    else:   # Country or Province or Region outside of US
 
-        global_cases = pd.read_csv(GlobalDataLocation + ConfirmedFile)
-        global_deaths = pd.read_csv(GlobalDataLocation + DeathsFile)
-        country_list = global_deaths[COUNTRY_REGION].tolist()
-        province_list = global_deaths[PROVINCE_STATE].tolist()
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# LOCATION INDEX -- every accepted spelling -> location in data-file
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-        if location in country_list:
 
-            column = COUNTRY_REGION
+IndexFile = 'location-index.json'
 
-        elif location in province_list:
 
-            column = PROVINCE_STATE
+class LocationIndex():
+    """
+    Prebuilt lookup tables, so resolving a location is a few dictionary lookups.
+    The precedence is the same as it always was: US states first, then the names
+    in the data-file, then the ISO 3166 names and codes, and finally <LocationExceptions>.
+    """
 
-        elif location in Countries:
+    def __init__(self, version=None, spellings=None, iso=None, alternatives=None, rows=None):
+        self.version = version
+        self.spellings = spellings or {}        # exact spelling -> [location, column]
+        self.iso = iso or {}                    # upper-cased ISO 3166 name or code -> [location, column, alternatives]
+        self.alternatives = alternatives or {}  # column -> location -> other names for it
+        self.rows = rows or {}                  # column -> location -> row indices in the Johns Hopkins files
+
+    @staticmethod
+    def build(dataset):
+        countries = dataset.load_global()
+        index = LocationIndex(version=dataset.index_version())
+        provinces = dataset.provinces
+
+        for column in [STATE, COUNTRY_REGION, PROVINCE_STATE]:
+            index.alternatives[column] = {}
+
+        for name, state in States.items():
+            index.spellings[name] = [state[NAME], STATE]
+            index.alternatives[STATE][state[NAME]] = [state[ABBREVIATION]]
+
+        # https://stackoverflow.com/questions/41245330/check-if-a-country-entered-is-one-of-the-countries-of-the-world
+
+        from iso3166 import countries as Countries
+
+        for column, names in [(COUNTRY_REGION, countries), (PROVINCE_STATE, provinces)]:
+            for name in names:
+                index.spellings.setdefault(name, [name, column])
+                if name in Countries:
+                    country = Countries.get(name)
+                    index.alternatives[column][name] = [name, country.name, country.alpha2, country.alpha3]
+
+        # ISO 3166 lookups ignore case, names are tried before apolitical names
+
+        for attribute in ['alpha2', 'alpha3', 'numeric', 'name', 'apolitical_name']:
+            for country in Countries:
+                name = country.name
+                if name in CountryExceptions.keys():
+                    name = CountryExceptions[name]
+                column = COUNTRY_REGION if name in countries else PROVINCE_STATE if name in provinces else None
+                index.iso.setdefault(getattr(country, attribute).upper(), [name, column, [country.name, country.alpha2, country.alpha3]])
+
+        for name, location in LocationExceptions.items():
+            if name.upper() not in index.iso:
+                index.spellings.setdefault(name, [location, COUNTRY_REGION])
+                if location in Countries and location not in index.alternatives[COUNTRY_REGION]:
+                    country = Countries.get(location)
+                    index.alternatives[COUNTRY_REGION][location] = [location, country.name, country.alpha2, country.alpha3]
+
+        index.rows = dataset.rows
+        return index
+
+    def resolve(self, location):
+        """
+        (location in data-file, column, alternative names) or None when unknown.
+        Column is None for a known country without data.
+        """
+        if location in self.spellings:
+            name, column = self.spellings[location]
+            return name, column, self.alternatives.get(column, {}).get(name, [])
+        if location.upper() in self.iso:
+            name, column, alternatives = self.iso[location.upper()]
+            return name, column, [location] + alternatives
+        return None
+
+    def save(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.__dict__, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as f:
+                return LocationIndex(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
 
-            # print("Country:", location)
-            country = Countries.get(location)
-            alternatives = [ location, country.name, country.alpha2, country.alpha3 ]   # there is also: numeric, apolitical
-            location = country.name
 
-            if location in CountryExceptions.keys():
-                location = CountryExceptions[location]
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# REGIONS -- sums and differences of locations and named regions
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-            if location in country_list:
-                column = COUNTRY_REGION
-            elif location in province_list:
-                column = PROVINCE_STATE
-            else:
-                print("No data available for:", location, "May need to add to CountryExceptions.")
-                return None, None, None
 
-        elif location in LocationExceptions.keys():
+RegionNames = {name.lower(): name for name in Regions}
 
-            # print("LocationException:", location)
-            location = LocationExceptions[location]
-            column = COUNTRY_REGION
 
+def normalize_location(location):
+    """
+    All lower case is taken as an abbreviation when short, otherwise as a name.
+    """
+    if location.islower():
+        return location.upper() if len(location) < 4 else location.capitalize()
+    return location
+
+
+def needed_files(names):
+    """
+    (states, countries): whether the NYT file, and the Johns Hopkins files,
+    are needed for the locations or named sets in names. A region may need both.
+    """
+    names = [normalize_location(name) for name in names]
+    states = [name in States or LocationSets.get(name.lower()) == STATES_SET for name in names]
+    regions = [name.lower() in RegionNames or re.search(r'[+-]', name) is not None for name in names]
+    return any(states) or any(regions), not all(states)
+
+
+def split_region(expression, known):
+    """
+    [(sign, part), ...] for an expression like "US-NY" or "Europe+UK-Russia".
+    Names can have a '-' in them, like Guinea-Bissau: the longest run of
+    pieces that known() accepts is one part.
+    """
+    pieces = re.split(r'([+-])', expression)
+    names, signs = pieces[0::2], pieces[1::2]
+    parts = []
+    sign = 1
+    start = 0
+    while start < len(names):
+        end = start
+        for stop in range(len(names) - 1, start, -1):
+            if all(item == '-' for item in signs[start:stop]) and known('-'.join(names[start:stop + 1]).strip()):
+                end = stop
+                break
+        parts.append((sign, '-'.join(names[start:end + 1]).strip()))
+        if end < len(signs):
+            sign = 1 if signs[end] == '+' else -1
+        start = end + 1
+    return parts
+
+
+def region_terms(expression, dataset):
+    """
+    Resolve a region expression: locations and named regions, added and
+    subtracted. Returns (name, terms, members) where terms are
+    (coefficient, column, location) and members the added and the subtracted
+    locations. For an unknown part it returns (part, None, None).
+    Locations of a named region without data are left out.
+    Parts are sets: a location added twice, as in Europe+UK, counts once,
+    and subtracting it again, or one that was not added, counts it once
+    as -1, so US-NY is the rest of the US.
+    """
+    index = dataset.location_index()
+
+    def group(part):
+        return RegionNames.get(part.lower()) or (part if part.lower() in LocationSets else None)
+
+    def known(part):
+        return group(part) is not None or index.resolve(normalize_location(part)) is not None
+
+    parts = split_region(expression, known)
+    coefficients = {}
+    for sign, part in parts:
+        if group(part) is not None:
+            resolved = [index.resolve(item) for item in expand_locations(Regions.get(group(part), [part]))]
+            resolved = [item for item in resolved if item is not None and item[1] is not None]
         else:
+            resolved = [index.resolve(normalize_location(part))]
+            if resolved[0] is None or resolved[0][1] is None:
+                return part, None, None
+        for location, column, alternatives in set((item[0], item[1], None) for item in resolved):
+            coefficient = coefficients.get((column, location), 0) + sign
+            coefficients[(column, location)] = max(-1, min(1, coefficient))
+
+    terms = [(coefficient, column, location) for (column, location), coefficient in coefficients.items() if coefficient != 0]
+    if len(terms) == 0:
+        return expression, None, None
+    members = ([location for coefficient, column, location in terms if coefficient > 0],
+               [location for coefficient, column, location in terms if coefficient < 0])
+
+    if len(parts) == 1:
+        name = group(parts[0][1])
+    else:
+        name = ''.join(('+' if sign > 0 else '-') + (group(part) or normalize_location(part)) for sign, part in parts).lstrip('+')
+    return name, terms, members
+
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# DATA
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def get_data(parameters):
+    """
+    Look up data for location, returns a Series, or None.
+    Location can be US states: MA, Ohio, NY, New Jersey, etc. abreviation or full name
+    Location can also be country or province, or some common abbreviation
+    US states get precedence for abreviations, i.e. CA is California, not Canada
+    Location can also be a region from regions.py, or locations and regions added
+    and subtracted: US-NY, New England, Europe+UK-Russia
+    Parameters are only read, the location as found is in the Series.
+    """
+    location = normalize_location(parameters[LOCATION])
+    startdate = parameters.get(STARTDATE, '2020-03-15')
+
+    dataset = load_dataset()
+    resolved = dataset.location_index().resolve(location)
+
+    if resolved is None:   # a region like "US-NY", "New England" or "Europe+UK"
+
+        location, terms, members = region_terms(parameters[LOCATION], dataset)
+        if terms is None:
             print("Unknown location:", location, ". Please add to <LocationExceptions>.")
             print("Abort")
-            return None, None, None
+            return None
 
-        if len(alternatives) == 0 and location in Countries:
-            country = Countries.get(location)
-            alternatives = [ location, country.name, country.alpha2, country.alpha3 ]   # there is also: numeric, apolitical
+        if parameters.get(VERBOSE, True) and len(terms) > 1:
+            print(location, "includes:", ', '.join(members[0]))
+            if len(members[1]) > 0:
+                print(location, "excludes:", ', '.join(members[1]))
 
-        # now finally get the data for the location!
+        dates, cumul_cases, cumul_deaths = dataset.region_series(terms)
+        alternatives = []
 
-        matching_rows = global_cases[column] == location
-        row = list(matching_rows[matching_rows == True].index)
-        if len(row) == 0:
-            print("Please add", location, "to <CountryExceptions>. for looking up the data coreectly.")
-            return None, None, None
+    elif resolved[1] is None:
 
-        if len(row) > 1 and column == COUNTRY_REGION:
-            states = [str(state) for state in global_cases[PROVINCE_STATE][row].tolist() if not isinstance(state, float)]
-            print(location, "includes:", ', '.join(states))
+        location = resolved[0]
+
+        print("No data available for:", location, "May need to add to CountryExceptions.")
+        return None
+
+    elif resolved[1] == STATE:   # US States
+
+        location, column, alternatives = resolved
+        dates, cumul_cases, cumul_deaths = dataset.state_series(location)
+
+    else:   # Country or Province outside of US
 
-        cases = np.array(global_cases.iloc[row, 4:].sum().tolist())
-        cumul_cases = np.transpose(cases[1:])
-        daily_cases = [0] + list(np.transpose(cases[1:] - cases[:-1]))
+        location, column, alternatives = resolved
 
-        deaths = np.array(global_deaths.iloc[row, 4:].sum().tolist())
-        cumul_deaths = np.transpose(deaths[1:])
-        daily_deaths = [0] + list(np.transpose(deaths[1:] - deaths[:-1]))
+        # now finally get the data for the location!
 
-        dates = global_deaths.loc[row[0]][4:].index.tolist()[1:]
-        dates = [datetime.strptime(x, '%m/%d/%y') for x in dates]
-        parameters[LASTDAY] = "Yesterday" if len(dates) == 0 else dates[-1].strftime("%Y-%m-%d")
+        series = dataset.global_series(column, location)
+        if series is None:
+            print("Please add", location, "to <CountryExceptions>. for looking up the data coreectly.")
+            return None
 
-        since_startdate = np.where(np.array(dates) >= datetime.strptime(startdate, '%Y-%m-%d'))
-        daily_deaths = np.array(daily_deaths)[since_startdate]
-        daily_cases = np.array(daily_cases)[since_startdate]
-        xvalues = [x for x in range(- len(daily_deaths) + 1, 1)]
+        provinces = dataset.country_provinces.get(location, []) if column == COUNTRY_REGION else []
+        if len(dataset.location_index().rows[column].get(location, [])) > 1 and parameters.get(VERBOSE, True):
+            states = [str(state) for state in provinces if state is not None]
+            print(location, "includes:", ', '.join(states))
 
-    # by now we have: location, alternatives, daily_cases, daily_deaths, xvalues, cumul_deaths, cumul_cases
+        cumul_cases, cumul_deaths = series
+        dates = dataset.global_dates
 
     alternatives = [item for item in alternatives if item != location]
-    alternatives = list(np.unique(alternatives))
-    alternatives = '(' + ', '.join(alternatives) + ')' if len(alternatives) > 0 else ''
-    if False and len(alternatives) == 0:
-        print(parameters[LOCATION], '->', location, '->', PlotExceptions[location] if location in PlotExceptions.keys() else location, "|", alternatives, cumul_deaths[-1], "dead")
-    parameters[LOCATION] = location
-
-    if True:
-        print("for", location, alternatives, "as of", parameters[LASTDAY])
+    series = Series(location, dates, cumul_cases, cumul_deaths, since_startdate(dates, startdate), sorted(set(alternatives)))
+
+    if parameters.get(VERBOSE, True):
+        alternatives = '(' + ', '.join(series.alternatives) + ')' if len(series.alternatives) > 0 else ''
+        print("for", location, alternatives, "as of", series.lastday)
         print()
-        print("latest daily DEATHS:", daily_deaths[-1], "total DEATHS:", cumul_deaths[-1])
-        print("latest daily CASES:", daily_cases[-1], "total CASES:", cumul_cases[-1])
+        print("latest daily DEATHS:", int(series.deaths[-1]), "total DEATHS:", series.total_deaths)
+        print("latest daily CASES:", int(series.cases[-1]), "total CASES:", series.total_cases)
 
-    return daily_cases, daily_deaths, xvalues
+    return series
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-# PLOT
+# SERIES -- float64 arrays, days along the last axis, so the same functions
+# work for one location and for a (locations x days) array of them
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
-def rolling_mean(x, N):
+def daily_values(cumulative):
+    """
+    Day-to-day differences of cumulative numbers, the first day is 0.
+    """
+    cumulative = np.asarray(cumulative, dtype=np.float64)
+    return np.diff(cumulative, axis=-1, prepend=cumulative[..., :1])
+
+
+def since_startdate(dates, startdate):
+    """
+    Index of the first of the (sorted) dates on or after startdate.
+    """
+    return int(np.searchsorted(dates, np.datetime64(startdate)))
+
+
+def relative_days(days):
+    """
+    x-values: days before the last day, which is 0.
+    """
+    return np.arange(- days + 1, 1)
+
+
+def rolling_mean(x, N, center=False):
+    """
+    Mean over a window of N days, trailing or centered on the day,
+    days outside of the series count as 0.
+    """
     # from https://stackoverflow.com/questions/13728392/moving-average-or-running-mean
-    sum = np.cumsum(np.insert([float(value) for value in x], 0, [0.0] * N)) 
-    return (sum[N:] - sum[:-N]) / float(N)
+    x = np.asarray(x, dtype=np.float64)
+    before = N // 2 if center else N - 1
+    sums = np.cumsum(np.pad(x, [(0, 0)] * (x.ndim - 1) + [(before + 1, N - 1 - before)]), axis=-1)
+    return (sums[..., N:] - sums[..., :-N]) / float(N)
+
+
+def clamp(x):
+    """
+    Negative numbers, from corrections in the data, become 0.
+    """
+    return np.maximum(x, 0.0)
+
+
+def series_fingerprint(cases, deaths, *details):
+    """
+    Short digest that changes when the daily cases or deaths, or any of details,
+    change. Fits and plots made for a fingerprint are still good for it.
+    """
+    digest = hashlib.sha1(np.asarray(cases, dtype=np.float64).tobytes())
+    digest.update(np.asarray(deaths, dtype=np.float64).tobytes())
+    digest.update(repr(details).encode())
+    return digest.hexdigest()[:16]
+
+
+def align_cumulative(dates, values, index):
+    """
+    Cumulative values on the dates of index: the last value on or before
+    each date, 0 before the first date.
+    """
+    positions = np.searchsorted(dates, index, side='right') - 1
+    return np.where(positions >= 0, np.asarray(values)[np.maximum(positions, 0)], 0)
+
+
+def stack_series(series):
+    """
+    Series of different lengths as one (locations x days) array, aligned on
+    the last day, missing days at the start are 0.
+    """
+    days = max(len(values) for values in series)
+    stacked = np.zeros((len(series), days))
+    for row, values in zip(stacked, series):
+        row[days - len(values):] = values
+    return stacked
+
+
+def read_only(values, dtype=None):
+    values = np.asarray(values, dtype=dtype).view()
+    values.flags.writeable = False
+    return values
+
+
+class Series():
+    """
+    What get_data found for a location: its name, the alternatives it is
+    also known by, and its dates with cumulative cases and deaths, shown
+    from day start on. Immutable, with read-only arrays, so the same Series
+    can be shared between batch items, threads and worker processes.
+    The daily values and xvalues are computed on first use, as views from
+    start on of the daily values of all dates.
+    """
+    __slots__ = ['location', 'alternatives', 'dates', 'cumulative_cases', 'cumulative_deaths', 'start', '_daily']
+
+    def __init__(self, location, dates, cumulative_cases, cumulative_deaths, start=0, alternatives=()):
+        for name, value in [('location', location), ('alternatives', tuple(alternatives)),
+                            ('dates', read_only(dates, 'datetime64[D]')),
+                            ('cumulative_cases', read_only(cumulative_cases)), ('cumulative_deaths', read_only(cumulative_deaths)),
+                            ('start', int(start)), ('_daily', {})]:
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Series is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Series is immutable")
+
+    def __reduce__(self):   # pickled for worker processes through the constructor
+        return Series, (self.location, self.dates, self.cumulative_cases, self.cumulative_deaths, self.start, self.alternatives)
+
+    def __len__(self):
+        return len(self.dates) - self.start
+
+    def daily(self, name, cumulative):
+        if name not in self._daily:
+            self._daily[name] = read_only(daily_values(cumulative))[self.start:]
+        return self._daily[name]
+
+    @property
+    def cases(self):
+        return self.daily(CASES, self.cumulative_cases)
+
+    @property
+    def deaths(self):
+        return self.daily(DEATHS, self.cumulative_deaths)
+
+    @property
+    def xvalues(self):
+        if XVALUES not in self._daily:
+            self._daily[XVALUES] = read_only(relative_days(len(self)))
+        return self._daily[XVALUES]
+
+    @property
+    def lastday(self):
+        return "Yesterday" if len(self.dates) == 0 else str(self.dates[-1])
+
+    @property
+    def total_cases(self):
+        return self.cumulative_cases[-1]
+
+    @property
+    def total_deaths(self):
+        return self.cumulative_deaths[-1]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# PLOT
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
 def covid_curve(x, offset, top, curve, slope, adjustment=0):
@@ -313,114 +973,264 @@ def covid_curve(x, offset, top, curve, slope, adjustment=0):
     return top / (1.0 + np.exp(- xx / curve) + np.exp(xx / slope))
 
 
+def covid_curve_jacobian(x, offset, top, curve, slope, adjustment=0):
+    """
+    Partial derivatives of covid_curve to (offset, top, curve, slope), one row per x.
+    The exponents are clipped, where that matters the derivatives are zero anyway.
+    """
+    xx = np.asarray(x, dtype=float) - offset - adjustment
+    rising = np.exp(np.clip(- xx / curve, -700, 700))
+    falling = np.exp(np.clip(xx / slope, -700, 700))
+    denominator = 1.0 + rising + falling
+    value = top / denominator
+    return np.column_stack([value * (falling / slope - rising / curve) / denominator,
+                            1.0 / denominator,
+                            - value * rising * xx / (curve * curve) / denominator,
+                            value * falling * xx / (slope * slope) / denominator])
+
+
+def predict(popts, past=180, horizons=(180,)):
+    """
+    What the models of many locations predict, for several horizons at once.
+    Popts has a row of covid_curve parameters per location, NaN where there is
+    no model, past is the number of days so far, the same for all locations or
+    one per location, and horizons are numbers of days from now.
+    Returns arrays: PEAK, the day of the peak relative to the last day, and
+    SOFAR, one per location, COMING and TOTAL, a row per location with a
+    column per horizon.
+    """
+    popts = np.atleast_2d(np.asarray(popts, dtype=float))
+    past = np.broadcast_to(np.asarray(past, dtype=int), len(popts))
+    horizons = np.asarray(horizons, dtype=int)
+    offset, top, curve, slope = popts.T
+    rows = np.arange(len(popts))
+
+    with np.errstate(all='ignore'):
+        peak = np.trunc(np.where((curve > 0) & (slope > 0), np.log(slope / curve) * slope * curve / (slope + curve), 0) + offset)
+        days = np.arange(-past.max(), horizons.max() + 1)
+        values = covid_curve(days, *popts.T[:, :, np.newaxis])
+
+    # running totals backwards from day -1 and forwards from day 1, day 0 is not counted
+
+    start = np.zeros((len(popts), 1))
+    before = np.hstack([start, np.cumsum(values[:, past.max() - 1::-1], axis=1)])
+    after = np.hstack([start, np.cumsum(values[:, past.max() + 1:], axis=1)])
+    sofar = before[rows, past]
+    coming = after[:, horizons]
+    return {PEAK: peak, SOFAR: sofar, COMING: coming, TOTAL: sofar[:, np.newaxis] + coming}
+
+
+def model_array(fits):
+    """
+    A list of covid_curve parameters, None for no model, as rows for predict.
+    """
+    return np.array([[np.nan] * 4 if popt is None else popt for popt in fits], dtype=float).reshape(-1, 4)
+
+
+def model_summary(popt, past=180, future=180):
+    """
+    What one model predicts: the day of the peak, relative to the last day, and
+    the numbers so far, still to come, and in total.
+    """
+    result = predict([popt], past, [future])
+    return {PEAK: int(result[PEAK][0]), SOFAR: result[SOFAR][0], COMING: result[COMING][0, 0], TOTAL: result[TOTAL][0, 0]}
+
+
 def covid_predict(curve_type, popt, past=180, future=180):
     print()
-    c, s = popt[2:4]
-    # print("c,s", c, s)
-    if c > 0 and s > 0:
-        peak = int(np.log(s / c) * s * c / (s + c) + popt[0])
-    else:
-        peak = popt[0]
+    summary = model_summary(popt, past, future)
+    peak = summary[PEAK]
     # print('model for', curve_type, popt)
     print('Model for', curve_type.upper() + ':', 'peak was ' + str(-peak) + ' days ago.' if peak < 0 else 'peak will come ' + str(peak) + ' days from now.')
-    sofar = sum(covid_curve(range(-past, 0), *popt))
-    coming = sum(covid_curve(range(1, future + 1), *popt))
-    print('Estimating', int(sofar), curve_type, 'so far, with', int(coming), 'more to come. Predicting a total of', int(sofar + coming), curve_type + '.')
+    print('Estimating', int(summary[SOFAR]), curve_type, 'so far, with', int(summary[COMING]), 'more to come. Predicting a total of', int(summary[TOTAL]), curve_type + '.')
 
 
-def plot_data(cases, deaths, xvalues, parameters):
+RtLimit = 4   # top of the R(t) panel, early estimates from few cases go far above it
+
+
+def plot_data(series, parameters, fits=None, output=None):
     """
+    Plot the daily cases and deaths of series with their rolling means and
+    models, and the deaths the lethality model expects from the cases.
+    The models are fitted here unless fits, from fit_models, are given or the
+    same series was fitted before, with warm, starting from the last fits for
+    the location.
+    With output, a file object, the plot is only written there, as PNG or
+    with svg as SVG. With report the plot is only drawn, the figure is
+    returned. With rt, R(t) from the daily cases is shown below.
     """
+    cases, deaths, xvalues = series.cases, series.deaths, series.xvalues
     cases_model = False
     deaths_model = False
     rolling_window = 7
     rolling_cases = rolling_mean(cases, rolling_window)
     rolling_deaths = rolling_mean(deaths, rolling_window)
 
-    try:
-        cases_popt, _ = curve_fit(covid_curve, xvalues, cases, p0=(-70, 2*max(rolling_cases), 5, 50))
-        covid_predict('cases', cases_popt, past=len(xvalues))
-        cases_model = True
-    except RuntimeError:
-        print("No cases-model due to weird data.")
+    if fits is None:
+        fits = cached_fits(cases, deaths, xvalues, parameters.get(WARM))
+        if fits is None:
+            warm = warm_start(series.location, series.lastday) if parameters.get(WARM) else None
+            with stage('fit', series.location):
+                fits = fit_models(cases, deaths, xvalues, rolling_window, warm)
+            remember_fits(series.location, series.lastday, fits)
+    cases_popt, deaths_popt = fits
 
-    try:
-        deaths_popt, _ = curve_fit(covid_curve, xvalues, deaths, p0=(-60, 2*max(rolling_deaths), 5, 50))
-        covid_predict('deaths', deaths_popt, past=len(xvalues))
-        deaths_model = True
-    except RuntimeError:
-        print("No deaths-model due to weird data.")
+    with stage('predict', series.location):
 
-    cases = [max(0, value) for value in cases]
-    deaths = [max(0, value) for value in deaths]
+        if cases_popt is None:
+            print("No cases-model due to weird data.")
+        else:
+            covid_predict('cases', cases_popt, past=len(xvalues))
+            cases_model = True
 
-    location = parameters[LOCATION]
-    if location in PlotExceptions.keys():
-        location = PlotExceptions[location]
+        if deaths_popt is None:
+            print("No deaths-model due to weird data.")
+        else:
+            covid_predict('deaths', deaths_popt, past=len(xvalues))
+            deaths_model = True
+
+    with stage('lethality', series.location):
+        lethality = modeling.lethality(cases, deaths)
+    if not np.isnan(lethality[modeling.FATALITY]):
+        print()
+        percent = [100 * lethality[key] for key in [modeling.FATALITY, modeling.FATALITY_LOW, modeling.FATALITY_HIGH]]
+        lag = [lethality[key] for key in [modeling.LAG, modeling.LAG_LOW, modeling.LAG_HIGH]]
+        print("{0} has a {1:.2f}% fatality rate ({2:.2f}-{3:.2f}%), and the lag is {4:.0f} days ({5:.0f}-{6:.0f}).".
+              format(plot_name(series.location), *percent, *lag))
+
+    reproduction = None
+    if parameters.get(RT):
+        with stage('rt', series.location):
+            # from all days, so the cases before the start date still count as infectious
+            reproduction = modeling.reproduction_number(daily_values(series.cumulative_cases))
+            reproduction = {key: value[series.start:] for key, value in reproduction.items()}
 
-    font = {'color': 'darkred', 'weight': 'normal', 'size': 16 }
+    cases = clamp(cases)
+    deaths = clamp(deaths)
+
+    location = plot_name(series.location)
+    headless = parameters.get(HEADLESS) or parameters.get(BATCH) or output is not None
+    font = {'color': 'darkred', 'weight': 'normal', 'size': 11 if headless else 16 }   # headless figures are much smaller than a window
 
     if parameters[XKCD]:
-        plt.xkcd()
+        import matplotlib.pyplot as plt
+        style = plt.xkcd()
     else:
+        style = contextlib.nullcontext()
         font[FAMILY] = SERIF
 
-    # fig, ax = plt.subplots(2, sharex=True)
-    fig, ax = plt.subplots(2, sharex=True, gridspec_kw={'hspace': 0.05})
+    with style:
+
+        with stage('render', series.location):
+            fig, ax = new_figure(headless, 2 if reproduction is None else 3)
+
+            ax[0].bar(xvalues, cases, label='Daily Cases', width=0.5, color='c')
+            ax[1].bar(xvalues, deaths, label='Daily Deaths', width=0.5, color='r')
+            ax[0].plot(xvalues, rolling_cases, label='Cases ' + str(rolling_window) + '-Day Average', color='c')
+            ax[1].plot(xvalues, rolling_deaths, label='Deaths ' + str(rolling_window) + '-Day Average', color='r')
+
+            if cases_model:
+                ax[0].plot(xvalues, covid_curve(np.array(xvalues), adjustment=3.5, *cases_popt), label='Cases Model', color='g')
+            if deaths_model:
+                ax[1].plot(xvalues, covid_curve(np.array(xvalues), adjustment=3.5, *deaths_popt), label='Deaths Model', color='g')
+            if not np.isnan(lethality[modeling.FATALITY]):
+                ax[1].plot(xvalues, lethality[modeling.EXPECTED], label='Deaths Given Cases', color='b', linewidth=0.8)
+
+            if reproduction is not None:
+                ax[2].fill_between(xvalues, reproduction[modeling.LOW], reproduction[modeling.HIGH], color='m', alpha=0.2,
+                                   label=str(int(100 * modeling.Interval)) + '% Interval')
+                ax[2].plot(xvalues, reproduction[modeling.RT], label='R(t) ' + str(modeling.Window) + '-Day Window', color='m')
+                ax[2].axhline(1, color='k', linewidth=0.8, linestyle='--')
+                ax[2].set_ylim(bottom=0, top=RtLimit)
+                ax[2].set_ylabel('R(t)', fontdict=font)
+                ax[1].label_outer()
+                ax[2].grid()
+                ax[2].legend()
+
+            ax[0].label_outer()
+            ax[0].grid()
+            ax[0].legend()
+            ax[1].grid()
+            ax[1].legend()
+
+            ax[0].set_ylabel('Number of Cases', fontdict=font)
+            ax[1].set_ylabel('Number of Deaths', fontdict=font)
+            ax[-1].set_xlabel('Days Before ' + series.lastday, fontdict=font)
+            # plt.suptitle(location + ': COVID-19 Cases, Deaths', fontdict=font)
+            ax[0].set_title(location + ': COVID-19 Cases, Deaths', fontdict=font)
+            fig.subplots_adjust(left=0.15)
+            # plt.tight_layout(pad=1)   # minimal padding
+
+            if YLIMIT in parameters:
+                if is_float(parameters[YLIMIT]):
+                    ax[0].set_ylim(bottom=0, top=float(parameters[YLIMIT]))
+                elif parameters[YLIMIT] == 'deaths':
+                    ax[0].set_ylim(bottom=0, top=max(deaths))
+                else:
+                    ax[1].set_ylim(bottom=0)
+            else:
+                ax[1].set_ylim(bottom=0)
 
-    ax[0].bar(xvalues, cases, label='Daily Cases', width=0.5, color='c')
-    ax[1].bar(xvalues, deaths, label='Daily Deaths', width=0.5, color='r')
-    ax[0].plot(xvalues, rolling_cases, label='Cases ' + str(rolling_window) + '-Day Average', color='c')
-    ax[1].plot(xvalues, rolling_deaths, label='Deaths ' + str(rolling_window) + '-Day Average', color='r')
+            if parameters.get(REPORT):   # a page of plot_report, which takes it from here
+                return fig
+            elif output is not None:
+                fig.savefig(output, format=SVG if parameters.get(SVG) else PNG)
+            else:
+                for name in plot_files(series.location, parameters, headless):
+                    fig.savefig(name)
 
-    if cases_model:
-        ax[0].plot(xvalues, covid_curve(np.array(xvalues), adjustment=3.5, *cases_popt), label='Cases Model', color='g')
-    if deaths_model:
-        ax[1].plot(xvalues, covid_curve(np.array(xvalues), adjustment=3.5, *deaths_popt), label='Deaths Model', color='g')
-    if deaths_model and cases_model:
-        print()
-        print("{0} has a {1:.2f}% fatality rate, and the lag is {2:.0f} days.".
-              format(location, 100 * deaths_popt[1] / cases_popt[1], deaths_popt[0] - cases_popt[0])) 
-
-        # plot cases given deaths
-        deaths_popt[1] *= 125  # one in 125 die
-        deaths_popt[0] -= 16   # die 21 days after infection, symptoms shw up after 5 days (21-5=16)
-        # ax.plot(xvalues, covid_curve(np.array(xvalues), *deaths_popt), color='b')
-
-        # plot deaths given cases
-        cases_popt[1] /= 125
-        cases_popt[0] += 16
-        # ax.plot(xvalues, covid_curve(np.array(xvalues), *cases_popt), color='b')
-
-    ax[0].label_outer()
-    ax[0].grid()
-    ax[0].legend()
-    ax[1].grid()
-    ax[1].legend()
-
-    ax[0].set_ylabel('Number of Cases', fontdict=font)
-    ax[1].set_ylabel('Number of Deaths', fontdict=font)
-    plt.xlabel('Days Before ' + parameters[LASTDAY], fontdict=font)
-    # plt.suptitle(location + ': COVID-19 Cases, Deaths', fontdict=font)
-    ax[0].set_title(location + ': COVID-19 Cases, Deaths', fontdict=font)
-    plt.subplots_adjust(left=0.15)
-    # plt.tight_layout(pad=1)   # minimal padding
-
-    if YLIMIT in parameters:
-        if is_float(parameters[YLIMIT]):
-            ax[0].set_ylim(bottom=0, top=float(parameters[YLIMIT]))
-        elif parameters[YLIMIT] == 'deaths':
-            ax[0].set_ylim(bottom=0, top=max(deaths))
-        else:
-            plt.ylim(bottom=0)
-    else:
-        plt.ylim(bottom=0)
+        if headless:
+            return
+
+        import matplotlib.pyplot as plt
+        plt.get_current_fig_manager().full_screen_toggle()   # Make full screen, need to use Qt5
+        plt.show()   # display plot on screen
+
+
+def plot_name(location):
+    if location in PlotExceptions.keys():
+        return PlotExceptions[location]
+    return location
+
+
+def plot_files(location, parameters, headless=False):
+    """
+    Files plot_data writes for location with parameters, headless at least a PNG.
+    """
+    formats = [item for item in [PDF, PNG, SVG] if parameters.get(item)]
+    if headless and len(formats) == 0:
+        formats = [PNG]
+    return [plot_name(location) + '-covid.' + item for item in formats]
+
+
+# headless plots are all drawn on one figure per number of panels
 
-    if parameters[PDF]:
-        fig.savefig(location + '-covid.pdf')
+FigureTemplates = {}
 
-    plt.get_current_fig_manager().full_screen_toggle()   # Make full screen, need to use Qt5
-    plt.show()   # display plot on screen
+
+def new_figure(headless=False, panels=2):
+    """
+    Figure with the cases and deaths panels, and with 3 panels R(t) below
+    them, returns (fig, ax).
+    On screen it is a pyplot figure with the Qt5 backend. Headless it is a plain
+    Figure that is only ever written to files, so neither Qt nor a window is
+    involved, and the same one is cleared and reused for every plot.
+    """
+    if not headless:
+        import matplotlib
+        matplotlib.use("Qt5Agg")
+        import matplotlib.pyplot as plt
+        return plt.subplots(panels, sharex=True, gridspec_kw={'hspace': 0.05})
+
+    if panels not in FigureTemplates:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(6.4, 2.4 * panels))
+        FigureTemplates[panels] = fig, fig.subplots(panels, sharex=True, gridspec_kw={'hspace': 0.05})
+
+    fig, ax = FigureTemplates[panels]
+    for axes in ax:
+        axes.clear()
+    return fig, ax
 
 
 def is_float(value):
@@ -431,6 +1241,190 @@ def is_float(value):
         return False
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# FITTING -- covid_curve models, optionally for many locations in parallel
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+# when a fit does not converge: try again from p0 with the offset shifted by
+# this many days, and allow this many function evaluations
+
+FitRetries = [(0, 2000), (-30, 2000), (30, 2000)]
+
+
+def fit_curve(xvalues, values, p0, warm=None, covariance=False):
+    """
+    Fit covid_curve to values, None if it does not converge.
+    Starts from warm, usually the last fit for the location, when given,
+    otherwise or if that fails from p0, followed by the FitRetries.
+    The same values fitted from the same p0 before come from the fit_cache,
+    except a fit that did not converge, which is tried again from warm.
+    With covariance, returns (popt, pcov), (None, None) if it does not converge.
+    """
+    key = fit_cache.fit_key(xvalues, values, p0)
+    cached = fit_cache.get(key)
+    if cached is not None and (cached[0] is not None or warm is None):
+        return cached if covariance else cached[0]
+
+    from scipy.optimize import curve_fit
+
+    attempts = ([(warm, 0)] if warm is not None else []) + [(p0, 0)]   # 0 evaluations: the default of curve_fit
+    attempts += [((p0[0] + shift,) + tuple(p0[1:]), evaluations) for shift, evaluations in FitRetries]
+    popt, pcov = None, None
+    for guess, evaluations in attempts:
+        try:
+            popt, pcov, info, message, flag = curve_fit(covid_curve, xvalues, values, p0=guess, jac=covid_curve_jacobian, maxfev=evaluations, full_output=True)
+            count_evaluations(info['nfev'])
+            break
+        except RuntimeError:
+            count_evaluations(None)
+
+    fit_cache.put(key, popt, pcov)
+    return (popt, pcov) if covariance else popt
+
+
+def fit_models(cases, deaths, xvalues, rolling_window=7, warm=None):
+    """
+    Fit the cases and deaths models, returns (cases_popt, deaths_popt)
+    where a model that could not be fitted is None.
+    Warm is (cases_popt, deaths_popt) of an earlier fit to start from.
+    """
+    cases_warm, deaths_warm = (None, None) if warm is None else warm
+    cases_p0, deaths_p0 = model_guesses(cases, deaths, rolling_window)
+    cases_popt = fit_curve(xvalues, cases, cases_p0, cases_warm)
+    deaths_popt = fit_curve(xvalues, deaths, deaths_p0, deaths_warm)
+    return cases_popt, deaths_popt
+
+
+def model_guesses(cases, deaths, rolling_window=7):
+    """
+    The p0 of the cases and deaths models.
+    """
+    return ((-70, 2*np.max(rolling_mean(cases, rolling_window)), 5, 50),
+            (-60, 2*np.max(rolling_mean(deaths, rolling_window)), 5, 50))
+
+
+def cached_fits(cases, deaths, xvalues, warm=False, rolling_window=7):
+    """
+    (cases_popt, deaths_popt) from the fit_cache when both series were fitted
+    before, otherwise None. With warm, a fit that did not converge is not
+    taken, fit_curve tries it again from the last fits.
+    """
+    fits = [fit_cache.get(fit_cache.fit_key(xvalues, values, p0))
+            for values, p0 in zip([cases, deaths], model_guesses(cases, deaths, rolling_window))]
+    if any(item is None or (warm and item[0] is None) for item in fits):
+        return None
+    return tuple(item[0] for item in fits)
+
+
+# the last fit of every location, to warm-start the next one, the fits
+# themselves are kept in the fit_cache
+
+WarmStartFile = 'last-fits.json'
+LastFits = None
+
+
+def last_fits():
+    global LastFits
+    if LastFits is None:
+        try:
+            with open(os.path.join(data_cache.CacheDirectory, WarmStartFile)) as f:
+                LastFits = json.load(f)
+        except (OSError, ValueError):
+            LastFits = {}
+    return LastFits
+
+
+def warm_start(location, lastday):
+    """
+    The last fits for location, (cases_popt, deaths_popt) or None,
+    with the offsets moved to count days before lastday.
+    """
+    fits = last_fits().get(location)
+    if fits is None:
+        return None
+    try:
+        days = int((np.datetime64(lastday) - np.datetime64(fits[LASTDAY])) / np.timedelta64(1, 'D'))
+    except ValueError:
+        return None
+    return tuple(None if popt is None else (popt[0] - days,) + tuple(popt[1:]) for popt in (fits[CASES], fits[DEATHS]))
+
+
+def remember_fits(location, lastday, fits, save=True):
+    last_fits()[location] = {LASTDAY: lastday,
+                             CASES: None if fits[0] is None else list(fits[0]), DEATHS: None if fits[1] is None else list(fits[1])}
+    if save:
+        save_fits()
+
+
+def save_fits():
+    path = os.path.join(data_cache.CacheDirectory, WarmStartFile)
+    os.makedirs(data_cache.CacheDirectory, exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(last_fits(), f)
+    os.replace(path + '.tmp', path)
+
+
+# the series of all locations, shared with the worker processes of fit_all()
+
+SharedSeries = None
+
+
+def start_worker():
+    global Profiler
+    Profiler = None   # a worker forked while profiling, the parent measures
+    tracemalloc.stop()
+
+
+def attach_series(name, shape):
+    global SharedSeries
+    from multiprocessing import shared_memory
+    start_worker()
+    memory = shared_memory.SharedMemory(name=name)
+    SharedSeries = (memory, np.ndarray(shape, dtype=np.float64, buffer=memory.buf))
+
+
+def fit_shared(span, warm=None):
+    start, end = span
+    series = SharedSeries[1]
+    return fit_models(series[0, start:end], series[1, start:end], relative_days(end - start), warm=warm)
+
+
+def fit_all(series, workers=None, chunksize=None, warm=None):
+    """
+    fit_models for a list of (daily cases, daily deaths), spread over a pool
+    of worker processes, results in the same order as series.
+    All series are packed into one block of shared memory, the workers only
+    get the start and end of their piece of it.
+    Warm is a list with the warm start for each series, or None.
+    """
+    workers = workers or os.cpu_count() or 1
+    warm = warm or [None] * len(series)
+    if workers == 1 or len(series) < 2:
+        return [fit_models(cases, deaths, relative_days(len(cases)), warm=start) for (cases, deaths), start in zip(series, warm)]
+
+    import scipy.optimize   # here, so the forked workers do not all import it again
+    from multiprocessing import shared_memory
+    from concurrent.futures import ProcessPoolExecutor
+
+    ends = np.cumsum([len(cases) for cases, deaths in series])
+    spans = list(zip([0] + list(ends[:-1]), ends))
+    memory = shared_memory.SharedMemory(create=True, size=max(1, 2 * int(ends[-1]) * 8))
+    try:
+        block = np.ndarray((2, ends[-1]), dtype=np.float64, buffer=memory.buf)
+        for (start, end), (cases, deaths) in zip(spans, series):
+            block[0, start:end] = cases
+            block[1, start:end] = deaths
+        del block
+
+        chunksize = chunksize or max(1, len(series) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_series, initargs=(memory.name, (2, int(ends[-1])))) as executor:
+            return list(executor.map(fit_shared, spans, warm, chunksize=chunksize))
+    finally:
+        memory.close()
+        memory.unlink()
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # ARGUMENTS
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -440,26 +1434,59 @@ def process_arguments(argv):
     """
     Process command line arguments, put into a {dict}
     Remaining arguments become the location.
+    With report, every location is a page of covid-report.pdf, a raster image
+    at ReportDPI, or with png a PNG in the directory covid-report.
     """
     parameters = {}
 
     parameters[PLOT] = True
+    parameters[BATCH] = BATCH in argv
 
     parameters[PDF] = PDF in argv
+    parameters[PNG] = PNG in argv
+    parameters[SVG] = SVG in argv
+    parameters[HEADLESS] = HEADLESS in argv
     parameters[XKCD] = XKCD in argv
     parameters[INFO] = INFO in argv
+    parameters[REFRESH] = REFRESH in argv
+    parameters[WARM] = WARM in argv
+    parameters[FORECAST] = FORECAST in argv
+    parameters[RT] = RT in argv
+    parameters[LETHALITY] = LETHALITY in argv
+    parameters[REPORT] = REPORT in argv
+    parameters[PROFILE] = PROFILE in argv or PROFILEJSON in argv
+    parameters[PROFILEJSON] = PROFILEJSON in argv
 
     for item in ['noplot', 'no-plot', 'info-only']:
         if item in argv:
             argv.remove(item)
             parameters[PLOT] = False
 
-    for item in [PDF, XKCD, INFO]:
+    for item in [PDF, PNG, SVG, HEADLESS, XKCD, INFO, REFRESH, BATCH, WARM, FORECAST, RT, LETHALITY, REPORT, PROFILE, PROFILEJSON]:
         if item in argv:
             argv.remove(item)
 
+    if 'grid-deaths' in argv:
+        argv.remove('grid-deaths')
+        parameters[GRID] = DEATHS
+    if GRID in argv:
+        argv.remove(GRID)
+        parameters[GRID] = CASES
+
+    for item in [WORKERS, PERPAGE]:
+        if item in argv[:-1]:
+            num = argv.index(item)
+            parameters[item] = int(argv[num + 1])
+            del argv[num:num + 2]
+
+    if CPROFILE in argv[:-1]:   # cprofile <stage>: also run that stage under cProfile
+        num = argv.index(CPROFILE)
+        parameters[CPROFILE] = argv[num + 1]
+        parameters[PROFILE] = True
+        del argv[num:num + 2]
+
     for item in [YLIMIT, 'ylimit', 'ylim', 'yscale', 'ymax']:
-        if item == argv[-1]:
+        if len(argv) > 0 and item == argv[-1]:
             num = argv.index(item)
             del argv[num]
             parameters[YLIMIT] = 'deaths'
@@ -472,9 +1499,455 @@ def process_arguments(argv):
 
     parameters[LOCATION] = 'Massachusetts' if len(argv) == 0 else ' '.join(argv)
 
+    if parameters[LOCATION].lower() in LocationSets and not parameters[BATCH] and not parameters[REPORT]:   # "States": small multiples of all states
+        parameters[BATCH] = True
+        parameters.setdefault(GRID, CASES)
+
+    if parameters[REPORT]:   # a report is always of a batch of locations
+        parameters[BATCH] = True
+
+    if parameters[BATCH]:   # batch: comma-separated locations or named sets, names like "Korea, South" are put back together later
+        parameters[LOCATIONS] = [STATES_SET] if len(argv) == 0 else [item.strip() for item in ' '.join(argv).split(',') if item.strip()]
+
     return parameters
 
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# BATCH -- many locations in one run
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def join_names(pieces, known):
+    """
+    Batch locations are split at every comma, but some names have a comma in
+    them, like "Korea, South": the longest run of pieces that known() accepts
+    is one name.
+    """
+    names = []
+    start = 0
+    while start < len(pieces):
+        end = start + 1
+        for stop in range(min(len(pieces), start + 3), start + 1, -1):   # no name has more than two commas
+            if known(', '.join(pieces[start:stop])):
+                end = stop
+                break
+        names.append(', '.join(pieces[start:end]))
+        start = end
+    return names
+
+
+def expand_locations(names):
+    """
+    Replace the named sets, like "states" or "countries", by their locations.
+    """
+    locations = []
+    for name in names:
+        named_set = LocationSets.get(name.lower())
+        if named_set == STATES_SET:
+            locations += sorted(set(state[NAME] for state in States.values()))
+        elif named_set == COUNTRIES_SET:
+            locations += sorted(load_dataset().load_global().keys())
+        else:
+            locations.append(name)
+    return locations
+
+
+def run_batch(parameters):
+    """
+    Look up every location in parameters[LOCATIONS] with the data loaded only once.
+    Print one summary table, and with pdf, png or svg also save one plot per
+    location, with the models of all locations fitted in parallel first.
+    Plots that were saved before for the same series are not drawn again,
+    and series that were fitted before are not fitted again.
+    With report, plot all locations as the pages of one report instead,
+    with grid as small multiples.
+    With forecast, also print what the models of all locations predict,
+    with rt, their latest R(t), with lethality, their fatality rate and lag.
+    Details per location are only printed with info.
+    """
+    summary = []
+    plots = []
+    grid = []
+    report = []
+    forecast = []
+    modeled = []
+    names = parameters[LOCATIONS]
+    if len(names) > 1:
+        index = load_dataset().location_index()
+        names = join_names(names, lambda name: index.resolve(normalize_location(name)) is not None)
+    for name in expand_locations(names):
+
+        with stage('series', name):
+            series = get_data(dict(parameters, **{LOCATION: name, VERBOSE: parameters[INFO]}))
+        if series is None:
+            summary.append((name, '-', '', '', '', ''))
+            continue
+
+        summary.append((series.location, series.lastday,
+                        int(series.cases[-1]), series.total_cases, int(series.deaths[-1]), series.total_deaths))
+
+        if parameters[PLOT] and parameters[REPORT]:
+            report.append(series)
+        elif parameters[PLOT] and parameters.get(GRID):
+            grid.append(series)
+        elif parameters[PLOT] and (parameters[PDF] or parameters[PNG] or parameters[SVG]):
+            plots.append(series)
+        if parameters[FORECAST]:
+            forecast.append(series)
+        if parameters[RT] or parameters[LETHALITY]:
+            modeled.append(series)
+
+    if len(plots) > 0:
+        plot_changed(plots, parameters)
+
+    print_summary(summary)
+
+    if len(forecast) > 0:
+        print_forecast(forecast, parameters)
+
+    if parameters[RT] and len(modeled) > 0:
+        print_reproduction(modeled)
+
+    if parameters[LETHALITY] and len(modeled) > 0:
+        print_lethality(modeled)
+
+    if len(grid) > 0:
+        with stage('grid'):
+            plot_grid(grid, parameters)
+
+    if len(report) > 0:
+        with stage(REPORT):
+            plot_report(report, parameters)
+
+    return summary
+
+
+PlotsFile = 'covid-plots.json'   # file -> fingerprint of what it shows, next to the plots
+PlotStyle = 2   # changed when the plots look different, so the saved ones are drawn again
+
+
+def plot_changed(plots, parameters):
+    """
+    Save the plots of run_batch, a list of Series, whose files are missing
+    or show older data.
+    """
+    try:
+        with open(PlotsFile) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+
+    todo = []
+    for series in plots:
+        fingerprint = series_fingerprint(series.cases, series.deaths, series.lastday, parameters[XKCD], parameters.get(YLIMIT), parameters.get(RT), PlotStyle)
+        files = plot_files(series.location, parameters, headless=True)
+        if not all(saved.get(name) == fingerprint and os.path.exists(name) for name in files):
+            todo.append((series, fingerprint, files))
+    if len(todo) < len(plots):
+        print(len(plots) - len(todo), "of", len(plots), "plots are up to date.")
+
+    fits = batch_fits([item[0] for item in todo], parameters)
+    for (series, fingerprint, files), location_fits in zip(todo, fits):
+        plot_data(series, parameters, location_fits)
+        saved.update({name: fingerprint for name in files})
+
+    with open(PlotsFile + '.tmp', 'w') as f:
+        json.dump(saved, f, indent=1)
+    os.replace(PlotsFile + '.tmp', PlotsFile)
+
+
+def batch_fits(series, parameters):
+    """
+    The fits for a list of Series, from the fit_cache for series that were
+    fitted before, the others fitted in parallel.
+    """
+    fits = [cached_fits(item.cases, item.deaths, item.xvalues, parameters.get(WARM)) for item in series]
+    missing = [index for index, location_fits in enumerate(fits) if location_fits is None]
+    if len(missing) > 0:
+        warm = [warm_start(series[index].location, series[index].lastday) for index in missing] if parameters[WARM] else None
+        with stage('fit-all'):
+            all_fits = fit_all([(series[index].cases, series[index].deaths) for index in missing], parameters.get(WORKERS), warm=warm)
+        for index, location_fits in zip(missing, all_fits):
+            fits[index] = location_fits
+            remember_fits(series[index].location, series[index].lastday, location_fits, save=False)
+        save_fits()
+    return fits
+
+
+ForecastHorizons = [7, 30, 90, 180]   # days ahead in the forecast table
+
+
+def print_forecast(series, parameters):
+    """
+    The predictions of the models of all locations of run_batch, computed at
+    once for all locations and ForecastHorizons.
+    Series is a list of Series.
+    """
+    fits = batch_fits(series, parameters)
+    past = [len(item) for item in series]
+    header = ('Location', 'Model', 'Peak', 'So Far') + tuple('Next ' + str(days) for days in ForecastHorizons)
+    width = max([len(header[0])] + [len(str(item.location)) for item in series])
+    line = '{0:<' + str(width) + '}  {1:<6}  {2:>5}  {3:>10}' + ''.join('  {' + str(column) + ':>10}' for column in range(4, len(header)))
+    print()
+    print(line.format(*header))
+    print(line.format(*['-' * len(item) for item in header]))
+
+    for which, name in enumerate([CASES, DEATHS]):
+        with stage('predict'):
+            result = predict(model_array([location_fits[which] for location_fits in fits]), past, ForecastHorizons)
+        for number, item in enumerate(series):
+            if np.isnan(result[PEAK][number]):
+                print(line.format(item.location, name, '-', '', *[''] * len(ForecastHorizons)))
+                continue
+            print(line.format(item.location, name, int(result[PEAK][number]), int(result[SOFAR][number]),
+                              *[int(value) for value in result[COMING][number]]))
+
+
+def print_reproduction(series):
+    """
+    The latest R(t) of all locations of run_batch, estimated in one pass over
+    all their daily cases since the first date, as of the last day with
+    enough cases for it.
+    Series is a list of Series.
+    """
+    with stage('rt'):
+        result = modeling.reproduction_number(stack_series([daily_values(item.cumulative_cases) for item in series]))
+    estimated = ~np.isnan(result[modeling.RT])
+    before = np.argmax(estimated[:, ::-1], axis=1)   # days before the last day
+
+    header = ('Location', 'As of', 'R(t)', 'Low', 'High')
+    width = max([len(header[0])] + [len(str(item.location)) for item in series])
+    line = '{0:<' + str(width) + '}  {1:<10}  {2:>5}  {3:>5}  {4:>5}'
+    print()
+    print(line.format(*header))
+    print(line.format(*['-' * len(item) for item in header]))
+    for number, item in enumerate(series):
+        if not estimated[number].any():
+            print(line.format(item.location, '-', '', '', ''))
+            continue
+        day = -1 - before[number]
+        values = ['{0:.2f}'.format(result[key][number, day]) for key in [modeling.RT, modeling.LOW, modeling.HIGH]]
+        print(line.format(item.location, str(np.datetime64(item.lastday) - before[number]), *values))
+
+
+def print_lethality(series):
+    """
+    Fatality rate and lag of all locations of run_batch, fitted in one pass.
+    Series is a list of Series.
+    """
+    with stage('lethality'):
+        result = modeling.lethality(stack_series([item.cases for item in series]), stack_series([item.deaths for item in series]))
+    header = ('Location', 'Fatality %', str(int(100 * modeling.Interval)) + '% Interval', 'Lag', str(int(100 * modeling.Interval)) + '% Interval')
+    width = max([len(header[0])] + [len(str(item.location)) for item in series])
+    line = '{0:<' + str(width) + '}  {1:>10}  {2:>12}  {3:>3}  {4:>12}'
+    print()
+    print(line.format(*header))
+    print(line.format(*['-' * len(item) for item in header]))
+    for number, item in enumerate(series):
+        if np.isnan(result[modeling.FATALITY][number]):
+            print(line.format(item.location, '-', '', '', ''))
+            continue
+        low, high = 100 * result[modeling.FATALITY_LOW][number], 100 * result[modeling.FATALITY_HIGH][number]
+        print(line.format(item.location, '{0:.2f}'.format(100 * result[modeling.FATALITY][number]), '{0:.2f}-{1:.2f}'.format(low, high),
+                          int(result[modeling.LAG][number]), '{0:.0f}-{1:.0f}'.format(result[modeling.LAG_LOW][number], result[modeling.LAG_HIGH][number])))
+
+
+def print_summary(summary):
+    header = ('Location', 'As of', 'Daily Cases', 'Total Cases', 'Daily Deaths', 'Total Deaths')
+    width = max([len(header[0])] + [len(str(row[0])) for row in summary])
+    line = '{0:<' + str(width) + '}  {1:<10}  {2:>11}  {3:>11}  {4:>12}  {5:>12}'
+    print()
+    print(line.format(*header))
+    print(line.format(*['-' * len(item) for item in header]))
+    for row in summary:
+        print(line.format(*[str(item) for item in row]))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# SMALL MULTIPLES -- many locations in one figure
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+GridColumns = 8
+
+
+def plot_grid(series, parameters, rolling_window=7):
+    """
+    Small multiples: a panel per location with its daily cases, or deaths with
+    grid-deaths, drawn as one LineCollection, plus its rolling mean as one line.
+    Series is a list of Series.
+    All panels on a page share their x axis. With per-page the panels are split
+    over pages, one PDF with all pages, or a PNG or SVG file per page.
+    Shown on screen unless headless or a file format is given.
+    """
+    which = parameters.get(GRID, CASES)
+    color = 'c' if which == CASES else 'r'
+    formats = [item for item in [PDF, PNG, SVG] if parameters.get(item)]
+    headless = parameters.get(HEADLESS) or len(formats) > 0
+    if parameters.get(HEADLESS) and len(formats) == 0:
+        formats = [PNG]
+
+    per_page = parameters.get(PERPAGE) or len(series)
+    columns = min(GridColumns, per_page)
+    rows = math.ceil(min(per_page, len(series)) / columns)
+    lastday = max(item.lastday for item in series)
+    stacked = stack_series([item.cases if which == CASES else item.deaths for item in series])
+    rolling = rolling_mean(stacked, rolling_window)
+    shown = clamp(stacked)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_pdf import PdfPages
+    if not headless:
+        import matplotlib
+        matplotlib.use("Qt5Agg")
+        import matplotlib.pyplot as plt
+
+    pdf = PdfPages('covid-grid.pdf') if PDF in formats else None
+
+    for page, start in enumerate(range(0, len(series), per_page), 1):
+
+        if headless:
+            fig = Figure(figsize=(2.4 * columns, 1.8 * rows))
+        else:
+            fig = plt.figure(figsize=(2.4 * columns, 1.8 * rows))
+        ax = fig.subplots(rows, columns, sharex=True, squeeze=False).flatten()
+
+        for number, axes in zip(range(start, min(start + per_page, len(series))), ax):
+            location, xvalues = series[number].location, series[number].xvalues
+            axes.vlines(xvalues, 0, shown[number, - len(xvalues):], color=color, linewidth=0.6, alpha=0.6)
+            axes.plot(xvalues, rolling[number, - len(xvalues):], color=color, linewidth=1.2)
+            axes.set_title(PlotExceptions.get(location, location), fontsize=9)
+            axes.tick_params(labelsize=7)
+            axes.set_ylim(bottom=0)
+
+        for axes in ax[len(series[start:start + per_page]):]:
+            axes.set_axis_off()
+
+        fig.suptitle('COVID-19 Daily ' + which.capitalize() + ', Days Before ' + lastday)
+        fig.subplots_adjust(left=0.04, right=0.98, bottom=0.05, top=0.92, hspace=0.5, wspace=0.3)
+
+        for item in formats:
+            if item == PDF:
+                pdf.savefig(fig)
+            else:
+                fig.savefig('covid-grid' + ('' if len(series) <= per_page else '-' + str(page)) + '.' + item)
+
+    if pdf is not None:
+        pdf.close()
+    if not headless:
+        plt.show()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# REPORT -- the plots of many locations, rendered in parallel
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+ReportFile = 'covid-report'   # .pdf, or the directory of the PNG pages
+ReportDPI = 150
+
+
+def plot_report(series, parameters):
+    """
+    The plot of every location in series, a list of Series, as a page of
+    covid-report.pdf, or with png as a numbered PNG per location in the
+    directory covid-report. The PDF pages are raster images at ReportDPI,
+    unlike the vector PDF of the pdf flag. The models are fitted first, in parallel as in
+    batch_fits, then the pages are rendered by a pool of worker processes,
+    each on its own headless figure, and written in the order of series
+    as they come in, so only a few pages are in memory at any time.
+    """
+    fits = batch_fits(series, parameters)
+    workers = min(parameters.get(WORKERS) or os.cpu_count() or 1, len(series))
+    page_parameters = dict(parameters, **{SVG: False})
+
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            pages = map(render_page, series, fits, [page_parameters] * len(series))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=start_worker))
+            pages = executor.map(render_page, series, fits, [page_parameters] * len(series),
+                                 chunksize=max(1, len(series) // (4 * workers)))
+
+        if parameters[PNG]:
+            shutil.rmtree(ReportFile, ignore_errors=True)   # pages of an earlier report
+            os.makedirs(ReportFile)
+            digits = len(str(len(series)))
+            for number, (item, page) in enumerate(zip(series, pages), 1):
+                with open(os.path.join(ReportFile, str(number).zfill(digits) + '-' + plot_name(item.location) + '-covid.png'), 'wb') as f:
+                    f.write(page)
+            print(len(series), "pages in", ReportFile)
+        else:
+            write_pdf(ReportFile + '.pdf', pages, len(series))
+            print(len(series), "pages in", ReportFile + '.pdf')
+
+
+def render_page(series, fits, parameters):
+    """
+    The plot of series at ReportDPI as PNG bytes, or for a PDF report as
+    the page image: (width, height, zlib-compressed RGB pixels) straight
+    from the Agg canvas. Runs in a worker process.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        fig = plot_data(series, parameters, fits)
+    if parameters[PNG]:
+        output = io.BytesIO()
+        fig.savefig(output, format=PNG, dpi=ReportDPI)
+        return output.getvalue()
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    dpi = fig.dpi
+    canvas = FigureCanvasAgg(fig)
+    try:
+        fig.set_dpi(ReportDPI)
+        canvas.draw()
+        pixels = np.asarray(canvas.buffer_rgba())[:, :, :3]
+        return pixels.shape[1], pixels.shape[0], zlib.compress(np.ascontiguousarray(pixels))
+    finally:
+        fig.set_dpi(dpi)
+
+
+def write_pdf(path, pages, count):
+    """
+    A PDF with a page per image, count pages of (width, height, compressed
+    RGB pixels) shown at ReportDPI. Written as the pages come in: objects
+    1 and 2 are the catalog and the page tree, then 3 per page, its page,
+    its contents and its image. Nothing is left behind when a page fails.
+    """
+    offsets = []
+    try:
+        with open(path + '.tmp', 'wb') as f:
+
+            def write_object(text, stream=None):
+                offsets.append(f.tell())
+                f.write(str(len(offsets)).encode() + b' 0 obj\n' + text.encode())
+                if stream is not None:
+                    f.write(b'\nstream\n' + stream + b'\nendstream')
+                f.write(b'\nendobj\n')
+
+            f.write(b'%PDF-1.4\n')
+            write_object('<< /Type /Catalog /Pages 2 0 R >>')
+            write_object('<< /Type /Pages /Count ' + str(count) + ' /Kids [' + ' '.join(str(3 + 3 * page) + ' 0 R' for page in range(count)) + '] >>')
+            for number, (width, height, pixels) in enumerate(pages):
+                size = '{0:.2f} {1:.2f}'.format(72 * width / ReportDPI, 72 * height / ReportDPI)
+                contents = ('q ' + size.replace(' ', ' 0 0 ') + ' 0 0 cm /Page Do Q').encode()
+                write_object('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 ' + size + ']'
+                             ' /Contents ' + str(4 + 3 * number) + ' 0 R /Resources << /XObject << /Page ' + str(5 + 3 * number) + ' 0 R >> >> >>')
+                write_object('<< /Length ' + str(len(contents)) + ' >>', contents)
+                write_object('<< /Type /XObject /Subtype /Image /Width ' + str(width) + ' /Height ' + str(height) +
+                             ' /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length ' + str(len(pixels)) + ' >>', pixels)
+
+            xref = f.tell()
+            f.write(('xref\n0 ' + str(len(offsets) + 1) + '\n0000000000 65535 f \n').encode())
+            f.write(''.join('{0:010d} 00000 n \n'.format(offset) for offset in offsets).encode())
+            f.write(('trailer\n<< /Size ' + str(len(offsets) + 1) + ' /Root 1 0 R >>\nstartxref\n' + str(xref) + '\n%%EOF\n').encode())
+    except BaseException:   # a page that failed to render, or an interrupt
+        with contextlib.suppress(OSError):
+            os.remove(path + '.tmp')
+        raise
+    os.replace(path + '.tmp', path)
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # TESTING
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -483,11 +1956,9 @@ def process_arguments(argv):
 def testing():
     """
     """
-    global_cases = pd.read_csv(GlobalDataLocation + ConfirmedFile)
-    global_deaths = pd.read_csv(GlobalDataLocation + DeathsFile)
-
-    country_list = global_deaths[COUNTRY_REGION].tolist()
-    province_list = global_deaths[PROVINCE_STATE].tolist()
+    dataset = load_dataset()
+    country_list = list(dataset.load_global().keys())
+    province_list = list(dataset.provinces.keys())
 
     # print()
     # print("country-list:", sorted(list(set(country_list))))
@@ -504,6 +1975,7 @@ def testing():
     return
 
     # Country(name='Zimbabwe', alpha2='ZW', alpha3='ZWE', numeric='716', apolitical_name='Zimbabwe')
+    from iso3166 import countries as Countries
     for c in Countries:
         # print()
         names = [ c.name, c.alpha2, c.alpha3, c.numeric, c.apolitical_name ]
@@ -524,9 +1996,26 @@ if __name__ == "__main__":
     # exit()
 
     parameters = process_arguments(sys.argv[1:])
-    cases, deaths, xvalues = get_data(parameters)
-    if parameters[PLOT] and not(cases is None):
-        plot_data(cases, deaths, xvalues, parameters)
+    if parameters[PROFILE]:
+        start_profile(parameters.get(CPROFILE))
+
+    if parameters[REFRESH]:
+        with stage(REFRESH):
+            load_dataset(refresh=True)
+
+    with stage('fetch'):
+        load_dataset().prefetch(*needed_files(parameters[LOCATIONS] if parameters[BATCH] else [parameters[LOCATION]]))
+
+    if parameters[BATCH]:
+        run_batch(parameters)
+    else:
+        with stage('series', parameters[LOCATION]):
+            series = get_data(parameters)
+        if parameters[PLOT] and not(series is None):
+            plot_data(series, parameters)
+
+    if parameters[PROFILE]:
+        print_profile(parameters[PROFILEJSON])
 
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
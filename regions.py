@@ -0,0 +1,28 @@
+# Named regions: region name -> the locations in it, spelled the way plot_covid accepts them
+# US states by abbreviation, countries by their name in the Johns Hopkins data-file,
+# a named set like "countries" stands for all its locations.
+# Census regions from https://www2.census.gov/geo/pdfs/maps-data/maps/reference/us_regdiv.pdf
+
+regions = {
+	'World': ['countries'],
+	'Europe': [
+		'Albania', 'Andorra', 'Austria', 'Belarus', 'Belgium', 'Bosnia and Herzegovina',
+		'Bulgaria', 'Croatia', 'Cyprus', 'Czechia', 'Denmark', 'Estonia', 'Finland',
+		'France', 'GE',   # Georgia, the country
+		'Germany', 'Greece', 'Holy See', 'Hungary', 'Iceland', 'Ireland', 'Italy',
+		'Kosovo', 'Latvia', 'Liechtenstein', 'Lithuania', 'Luxembourg', 'Malta',
+		'Moldova', 'Monaco', 'Montenegro', 'Netherlands', 'North Macedonia', 'Norway',
+		'Poland', 'Portugal', 'Romania', 'Russia', 'San Marino', 'Serbia', 'Slovakia',
+		'Slovenia', 'Spain', 'Sweden', 'Switzerland', 'Ukraine', 'United Kingdom'],
+	'New England': ['CT', 'ME', 'MA', 'NH', 'RI', 'VT'],
+	'Northeast': ['CT', 'ME', 'MA', 'NH', 'RI', 'VT', 'NJ', 'NY', 'PA'],
+	'Midwest': ['IL', 'IN', 'MI', 'OH', 'WI', 'IA', 'KS', 'MN', 'MO', 'NE', 'ND', 'SD'],
+	'South': ['DE', 'DC', 'FL', 'GA', 'MD', 'NC', 'SC', 'VA', 'WV', 'AL', 'KY', 'MS', 'TN', 'AR', 'LA', 'OK', 'TX'],
+	'West': ['AZ', 'CO', 'ID', 'MT', 'NV', 'NM', 'UT', 'WY', 'AK', 'CA', 'HI', 'OR', 'WA'],
+	# won by Clinton and by Trump in the 2016 presidential election
+	'Clinton': ['CA', 'CO', 'CT', 'DE', 'DC', 'HI', 'IL', 'ME', 'MD', 'MA', 'MN',
+		'NV', 'NH', 'NJ', 'NM', 'NY', 'OR', 'RI', 'VT', 'VA', 'WA'],
+	'Trump': ['AL', 'AK', 'AZ', 'AR', 'FL', 'GA', 'ID', 'IN', 'IA', 'KS', 'KY', 'LA',
+		'MI', 'MS', 'MO', 'MT', 'NE', 'NC', 'ND', 'OH', 'OK', 'PA', 'SC', 'SD', 'TN',
+		'TX', 'UT', 'WV', 'WI', 'WY'],
+}
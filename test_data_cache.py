@@ -0,0 +1,354 @@
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# TEST DATA CACHE -- data_cache against a local stand-in HTTP server
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+"""
+Tests of data_cache against a stand-in for the data servers, an http.server
+on localhost that serves files with ETags, conditional GETs and byte ranges.
+Run with python -m unittest test_data_cache, or with pytest.
+"""
+
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import data_cache
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# STAND-IN SERVER
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+def csv_rows(first, last):
+    return b''.join(b'2020-03-%04d,Massachusetts,25,%d,%d\n' % (day, 100 * day, day) for day in range(first, last))
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    GET of the files of the server, with ETag, If-None-Match and Range, and
+    with what the server is told to do wrong: answer with a status from
+    failures first, redirect, take delay seconds, or close every connection
+    after one response without saying so.
+    Full urls in the request line, as sent to a proxy, are served as well.
+    """
+
+    protocol_version = 'HTTP/1.1'   # keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        try:
+            time.sleep(server.delay)
+            self.answer(urllib.parse.urlsplit(self.path).path)
+        finally:
+            with server.lock:
+                server.active -= 1
+            if server.close_idle:
+                self.close_connection = True
+
+    def answer(self, path):
+        server = self.server
+        if server.failures.get(path):
+            self.send(server.failures[path].pop(0), b'failure')
+            return
+        if path in server.redirects:
+            self.send(301, headers={'Location': server.redirects[path]})
+            return
+        body = server.files.get(path)
+        if body is None:
+            self.send(404)
+            return
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send(304, etag=etag)
+            return
+        ranged = self.headers.get('Range', '')
+        if ranged.startswith('bytes=') and ranged.endswith('-'):
+            start = int(ranged[len('bytes='):-1])
+            if start >= len(body):
+                self.send(416, headers={'Content-Range': 'bytes */' + str(len(body))})
+                return
+            self.send(206, body[start:], etag, {'Content-Range': 'bytes %d-%d/%d' % (start, len(body) - 1, len(body))})
+            return
+        self.send(200, body, etag)
+
+    def send(self, status, body=b'', etag=None, headers=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Server on a free port of localhost, running in a thread until shutdown.
+    files: path -> bytes, requests: (path, headers) of every GET,
+    failures: path -> statuses to answer first, redirects: path -> location.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler=Handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.files = {}
+        self.requests = []
+        self.failures = {}
+        self.redirects = {}
+        self.delay = 0
+        self.close_idle = False
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.active = 0
+        self.most_active = 0
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def shutdown(self):
+        super().shutdown()
+        self.server_close()
+
+
+class CacheTest(unittest.TestCase):
+    """
+    A new stand-in server, cache directory and connection pool for every test.
+    """
+
+    def setUp(self):
+        self.server = StandIn()
+        self.directory = tempfile.mkdtemp()
+        proxies = mock.patch.dict(os.environ, {'no_proxy': '*', 'NO_PROXY': '*'})
+        proxies.start()
+        self.addCleanup(proxies.stop)
+        delay = mock.patch.object(data_cache, 'RetryDelay', 0.01)
+        delay.start()
+        self.addCleanup(delay.stop)
+        clear_pool()
+
+    def tearDown(self):
+        clear_pool()
+        self.server.shutdown()
+        shutil.rmtree(self.directory)
+
+    def fetch(self, path, **options):
+        return data_cache.fetch(self.server.url(path), directory=self.directory, **options)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def counted(self, key, before):
+        return data_cache.Statistics[key] - before[key]
+
+
+def clear_pool():
+    with data_cache.PoolLock:
+        for connections in data_cache.Pool.values():
+            for connection in connections:
+                connection.close()
+        data_cache.Pool.clear()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CACHE -- fetch, revalidate and fetch_appended
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class FetchTest(CacheTest):
+
+    def test_cold_download(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv')
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+        self.assertEqual(self.counted(data_cache.DOWNLOADS, before), 1)
+        self.assertEqual(data_cache.version(self.server.url('/us-states.csv'), self.directory), hashlib.sha1(csv_rows(1, 200)).hexdigest())
+
+    def test_warm_hit_stays_off_the_network(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv')
+        requests = len(self.server.requests)
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv', ttl=3600)
+        self.assertEqual(len(self.server.requests), requests)
+        self.assertEqual(self.counted(data_cache.HITS, before), 1)
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+
+    def test_not_modified(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv')
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv', ttl=0)
+        self.assertIn('If-None-Match', self.server.requests[-1][1])
+        self.assertEqual(self.counted(data_cache.NOT_MODIFIED, before), 1)
+        self.assertEqual(self.counted(data_cache.DOWNLOADS, before), 0)
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+
+    def test_changed_file_is_downloaded_again(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv')
+        self.server.files['/us-states.csv'] = csv_rows(1, 100)
+        path = self.fetch('/us-states.csv', ttl=0)
+        self.assertEqual(self.read(path), csv_rows(1, 100))
+
+    def test_append(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv', append=True)
+        self.server.files['/us-states.csv'] = csv_rows(1, 300)
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv', ttl=0, append=True)
+        self.assertTrue(self.server.requests[-1][1].get('Range', '').startswith('bytes='))
+        self.assertEqual(self.counted(data_cache.APPENDS, before), 1)
+        self.assertEqual(self.counted(data_cache.DOWNLOADS, before), 0)
+        self.assertLess(self.counted(data_cache.BYTES, before), len(csv_rows(1, 300)))
+        self.assertEqual(self.read(path), csv_rows(1, 300))
+        self.assertEqual(data_cache.version(self.server.url('/us-states.csv'), self.directory), hashlib.sha1(csv_rows(1, 300)).hexdigest())
+
+    def test_append_not_modified(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv', append=True)
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv', ttl=0, append=True)
+        self.assertEqual(self.counted(data_cache.NOT_MODIFIED, before), 1)
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+
+    def test_append_overlap_mismatch(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv', append=True)
+        changed = csv_rows(1, 199).replace(b'Massachusetts,25,19800,198', b'Massachusetts,25,19800,199') + csv_rows(200, 300)
+        self.server.files['/us-states.csv'] = changed
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv', ttl=0, append=True)
+        self.assertEqual(self.counted(data_cache.APPENDS, before), 0)
+        self.assertEqual(self.counted(data_cache.DOWNLOADS, before), 1)
+        self.assertEqual(self.read(path), changed)
+
+    def test_append_smaller_file(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 400)
+        self.fetch('/us-states.csv', append=True)
+        self.server.files['/us-states.csv'] = csv_rows(1, 10)
+        before = dict(data_cache.Statistics)
+        path = self.fetch('/us-states.csv', ttl=0, append=True)
+        self.assertEqual(self.counted(data_cache.DOWNLOADS, before), 1)
+        self.assertEqual(self.read(path), csv_rows(1, 10))
+
+    def test_cached_copy_when_server_is_gone(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.fetch('/us-states.csv')
+        del self.server.files['/us-states.csv']
+        with mock.patch('builtins.print'):
+            path = self.fetch('/us-states.csv', ttl=0)
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+
+    def test_missing_file(self):
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.fetch('/missing.csv')
+        self.assertEqual(raised.exception.code, 404)
+
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# CONNECTIONS -- pool, retries, redirects, proxies and fetch_many
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+
+class ConnectionTest(CacheTest):
+
+    def test_connection_is_kept_alive(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.server.files['/confirmed.csv'] = csv_rows(1, 100)
+        self.fetch('/us-states.csv')
+        path = self.fetch('/confirmed.csv')
+        self.assertEqual(self.read(path), csv_rows(1, 100))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_retry_after_dropped_connection(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.server.files['/confirmed.csv'] = csv_rows(1, 100)
+        self.server.close_idle = True
+        self.fetch('/us-states.csv')
+        self.assertEqual(sum(len(connections) for connections in data_cache.Pool.values()), 1)
+        path = self.fetch('/confirmed.csv')
+        self.assertEqual(self.read(path), csv_rows(1, 100))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_retry_after_server_error(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.server.failures['/us-states.csv'] = [500]
+        path = self.fetch('/us-states.csv')
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_server_errors_give_up(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.server.failures['/us-states.csv'] = [503] * (data_cache.Retries + 2)
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            self.fetch('/us-states.csv')
+        self.assertEqual(raised.exception.code, 503)
+        self.assertEqual(len(self.server.requests), data_cache.Retries + 1)
+
+    def test_redirect(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.server.redirects['/old/us-states.csv'] = '/us-states.csv'
+        path = self.fetch('/old/us-states.csv')
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+
+    def test_proxy(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        proxy = self.server.url('')
+        with mock.patch.dict(os.environ, {'http_proxy': proxy, 'HTTP_PROXY': proxy, 'no_proxy': '', 'NO_PROXY': ''}):
+            path = data_cache.fetch('http://data.invalid/us-states.csv', directory=self.directory)
+        self.assertEqual(self.read(path), csv_rows(1, 200))
+        self.assertEqual(self.server.requests[-1][0], 'http://data.invalid/us-states.csv')
+
+    def test_fetch_many_at_the_same_time(self):
+        names = ['/us-states.csv', '/confirmed.csv', '/deaths.csv', '/recovered.csv']
+        for number, name in enumerate(names):
+            self.server.files[name] = csv_rows(1, 100 + number)
+        self.server.delay = 0.2
+        paths = data_cache.fetch_many([self.server.url(name) for name in names], directory=self.directory)
+        self.assertEqual([self.read(path) for path in paths], [csv_rows(1, 100 + number) for number in range(len(names))])
+        self.assertGreater(self.server.most_active, 1)
+
+    def test_fetch_many_error(self):
+        self.server.files['/us-states.csv'] = csv_rows(1, 200)
+        self.server.files['/confirmed.csv'] = csv_rows(1, 100)
+        self.server.delay = 0.1
+        urls = [self.server.url(name) for name in ['/us-states.csv', '/missing.csv', '/confirmed.csv']]
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            data_cache.fetch_many(urls, directory=self.directory)
+        self.assertEqual(raised.exception.code, 404)
+        self.assertTrue(data_cache.read_metadata(urls[0], self.directory))
+        self.assertTrue(data_cache.read_metadata(urls[2], self.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()